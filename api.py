@@ -0,0 +1,299 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pandas as pd
+from fastapi import FastAPI, File, Form, Header, HTTPException, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from backend.cascade import get_strong_backend
+from backend.chunker import DEFAULT_MAX_TOKENS
+from backend.extract import iter_extracted_rows, load_chunks, location_column_for
+from backend.extract_by_label import build_label_index, extract_label_spans, iter_label_index_rows
+from backend.llm import BACKENDS, DEFAULT_BACKEND, resolve_backend
+from backend.dedup import dedupe_policies
+from backend.policy_index import get_policy_index, index_extracted_policies
+from backend.rag import EXAMPLE_CORPORA
+from backend.ratelimit import RESPONSE_CACHE, admit_all, all_controllers, all_schedulers, get_scheduler, scheduled_job
+from backend.spool import SpooledUpload
+
+##################################################################
+# Policy Extractor API
+#
+# Same pipeline as the Streamlit app, exposed as asynchronous jobs:
+#   POST /jobs                 upload a document, get a job id back
+#   GET  /jobs/{id}            status and progress
+#   GET  /jobs/{id}/results    rows as NDJSON, streamed while the job runs
+#   GET  /duplicates           near-duplicate policies across the tenant's indexed plans
+#
+# Every tenant (X-Tenant-ID header) shares one worker pool, and every LLM
+# call goes through the process-wide scheduler and response cache in
+# query_gemini, so more tenants never means more requests than the quota.
+# Tenants get fair turns at the quota, in proportion to their weight in
+# POLICY_API_TENANT_WEIGHTS (e.g. "planning=3,public=1", default 1 each);
+# small documents go ahead of big ones.
+# Finished jobs (and their rows) are kept for POLICY_API_JOB_TTL seconds.
+#
+# Run with: uvicorn api:app
+
+MAX_JOB_WORKERS = int(os.environ.get("POLICY_API_WORKERS", "4"))
+SUPPORTED_TYPES = (".pdf", ".docx", ".txt")
+POLL_SECONDS = 0.5
+JOB_TTL_SECONDS = int(os.environ.get("POLICY_API_JOB_TTL", "3600"))   # how long finished jobs stay fetchable
+
+
+# "planning=3,public=1" -> {"planning": 3.0, "public": 1.0}
+def _parse_weights(value):
+    weights = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            tenant, weight = item.split("=")
+            weights[tenant.strip()] = float(weight)
+    return weights
+
+
+TENANT_WEIGHTS = _parse_weights(os.environ.get("POLICY_API_TENANT_WEIGHTS"))
+
+app = FastAPI(title="Policy Extractor API")
+executor = ThreadPoolExecutor(max_workers=MAX_JOB_WORKERS, thread_name_prefix="policy-job")
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _split_labels(value):
+    return [label.strip() for label in (value or "").split(",") if label.strip()]
+
+
+# Drop finished jobs past their TTL so rows don't pile up in memory forever.
+# A results stream still running keeps its own reference to the job.
+def _evict_finished_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with _jobs_lock:
+        for job_id in [job_id for job_id, job in _jobs.items() if job["finished"] and job["finished"] < cutoff]:
+            del _jobs[job_id]
+
+
+def _get_job(job_id, tenant):
+    _evict_finished_jobs()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    # Other tenants' jobs are indistinguishable from missing ones
+    if job is None or job["tenant"] != tenant:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def _job_status(job):
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "file_name": job["file_name"],
+        "mode": job["mode"],
+        "processed": len(job["rows"]),
+        "total": job["total"],
+        "model_pages": job["model_pages"],
+        "indexed": job["indexed"],
+        "label_counts": job["label_counts"],
+        "ocr_failures": sorted(job["ocr_failures"]),
+        "error": job["error"],
+    }
+
+##################################################################
+# Job runner
+
+def _run_job(job, doc, options):
+    job["status"] = "running"
+    try:
+        backend = resolve_backend(options["backend"])
+        location_column = location_column_for(doc)
+        schedulers = [get_scheduler(backend)]
+
+        if job["mode"] == "labels":
+            # Regex pre-scan first: only pages with labels count against the quota
+            label_index = build_label_index(doc, options["labels"], options["excluded_labels"])
+            job["label_counts"] = label_index["label_counts"]
+            job["ocr_failures"].extend(label_index["ocr_failures"])
+            # Well-labelled pages are cut locally; only unclear ones count against the quota
+            if options["local"]:
+                extracted, model_pages = extract_label_spans(label_index, options["labels"])
+            else:
+                extracted, model_pages = {}, label_index["pages"]
+            # Rows cover every labelled page; only model_pages count against the quota
+            job["total"], job["model_pages"] = len(label_index["pages"]), len(model_pages)
+            requests, unit = len(model_pages), label_index["unit"]
+            rows = iter_label_index_rows(label_index, extracted, model_pages, options["labels"],
+                                         options["excluded_labels"], backend, location_column)
+        else:
+            chunks, requests, unit = load_chunks(doc, chunking=options["chunking"], max_tokens=options["max_tokens"])
+            job["total"] = job["model_pages"] = requests
+            strong_backend = get_strong_backend() if options["cascade"] else None
+            # Worst case the cascade escalates every chunk: reserve the strong model's quota too
+            if strong_backend is not None:
+                schedulers.append(get_scheduler(strong_backend))
+            rows = iter_extracted_rows(chunks, location_column, unit, backend, options["cascade"], strong_backend,
+                                       options["corpus"], job["ocr_failures"])
+
+        # Admission control: the daily quota is shared by every tenant
+        for scheduler in schedulers:
+            scheduler.set_weight(job["tenant"], TENANT_WEIGHTS.get(job["tenant"], 1.0))
+        refused = admit_all(schedulers, job["tenant"], requests)
+        if refused is not None:
+            raise RuntimeError(f"Not enough daily quota left for {requests} {unit} "
+                               f"({refused.remaining_today()} requests left today)")
+
+        with scheduled_job(schedulers, job["tenant"], requests):
+            for row in rows:
+                if options["city"]:
+                    row = {"City": options["city"], **row}
+                job["rows"].append(row)
+
+        if job["rows"]:
+            job["indexed"] = index_extracted_policies(pd.DataFrame(job["rows"]), options["city"], job["file_name"],
+                                                      tenant=job["tenant"])
+        job["status"] = "done"
+    except Exception as e:
+        job["error"] = str(e)
+        job["status"] = "failed"
+    finally:
+        doc.close()
+        job["finished"] = time.time()
+
+##################################################################
+# Endpoints
+
+@app.post("/jobs")
+async def create_job(
+    file: UploadFile = File(...),
+    mode: str = Form("quick"),
+    backend: str = Form(DEFAULT_BACKEND),
+    chunking: str = Form("page"),
+    cascade: bool = Form(False),
+    corpus: str = Form(None),
+    max_tokens: int = Form(DEFAULT_MAX_TOKENS),
+    labels: str = Form(""),
+    excluded_labels: str = Form(""),
+    local: bool = Form(True),
+    city: str = Form(""),
+    x_tenant_id: str = Header(...),
+):
+    file_name = file.filename or ""
+    if not file_name.lower().endswith(SUPPORTED_TYPES):
+        raise HTTPException(status_code=400, detail=f"Unsupported file type. Upload one of: {', '.join(SUPPORTED_TYPES)}")
+    if mode not in ("quick", "labels"):
+        raise HTTPException(status_code=400, detail="mode must be 'quick' or 'labels'")
+    if backend not in BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Unknown backend. Choose from: {', '.join(BACKENDS)}")
+    if chunking not in ("page", "section"):
+        raise HTTPException(status_code=400, detail="chunking must be 'page' or 'section'")
+    if corpus and corpus not in EXAMPLE_CORPORA:
+        raise HTTPException(status_code=400, detail=f"Unknown corpus. Choose from: {', '.join(EXAMPLE_CORPORA)}")
+    if mode == "labels" and not _split_labels(labels):
+        raise HTTPException(status_code=400, detail="labels are required in labels mode")
+
+    _evict_finished_jobs()
+
+    # Spool to disk in pieces: the job reads pages from the file, never the whole upload into memory
+    doc = await run_in_threadpool(SpooledUpload, file.file, file_name.lower())
+    job = {
+        "id": uuid.uuid4().hex,
+        "tenant": x_tenant_id,
+        "file_name": file_name.lower(),
+        "mode": mode,
+        "status": "queued",
+        "rows": [],
+        "total": None,
+        "model_pages": None,
+        "indexed": 0,
+        "label_counts": None,
+        "ocr_failures": [],
+        "error": None,
+        "created": time.time(),
+        "finished": None,
+    }
+    options = {
+        "backend": backend,
+        "chunking": chunking,
+        "cascade": cascade,
+        "corpus": corpus or None,
+        "max_tokens": max_tokens,
+        "labels": _split_labels(labels),
+        "excluded_labels": _split_labels(excluded_labels),
+        "local": local,
+        "city": city,
+    }
+    with _jobs_lock:
+        _jobs[job["id"]] = job
+    executor.submit(_run_job, job, doc, options)
+    return _job_status(job)
+
+
+@app.get("/jobs")
+def list_jobs(x_tenant_id: str = Header(...)):
+    _evict_finished_jobs()
+    with _jobs_lock:
+        jobs = [job for job in _jobs.values() if job["tenant"] == x_tenant_id]
+    return [_job_status(job) for job in sorted(jobs, key=lambda j: j["created"])]
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, x_tenant_id: str = Header(...)):
+    return _job_status(_get_job(job_id, x_tenant_id))
+
+
+# Rows come out as soon as they are extracted, one JSON object per line
+@app.get("/jobs/{job_id}/results")
+def get_job_results(job_id: str, x_tenant_id: str = Header(...)):
+    job = _get_job(job_id, x_tenant_id)
+
+    def stream():
+        sent = 0
+        while True:
+            finished = job["status"] in ("done", "failed")
+            rows = job["rows"]
+            while sent < len(rows):
+                yield json.dumps(rows[sent], default=str) + "\n"
+                sent += 1
+            if finished:
+                break
+            time.sleep(POLL_SECONDS)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# Near-duplicate policies across every plan this tenant indexed (optionally only some cities):
+# one entry per group that was found more than once, largest first
+@app.get("/duplicates")
+def get_duplicates(city: List[str] = Query(None), min_copies: int = 2, x_tenant_id: str = Header(...)):
+    policies_df = get_policy_index().to_dataframe(city=city or None, tenant=x_tenant_id)
+    if policies_df.empty:
+        return []
+    policies_df = dedupe_policies(policies_df)
+    groups = []
+    for _, group in policies_df[policies_df["Copies"] >= min_copies].groupby("Duplicate Group"):
+        canonical = group[group["Canonical"]].iloc[0]
+        groups.append({
+            "policy": canonical["Policy"],
+            "copies": len(group),
+            "documents": sorted(set(zip(group["City"], group["Document"]))),
+        })
+    return sorted(groups, key=lambda g: g["copies"], reverse=True)
+
+
+@app.get("/metrics")
+def metrics():
+    _evict_finished_jobs()
+    with _jobs_lock:
+        statuses = [job["status"] for job in _jobs.values()]
+    return {
+        "jobs": {status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+        "cache": {"entries": len(RESPONSE_CACHE.entries), "hits": RESPONSE_CACHE.hits, "misses": RESPONSE_CACHE.misses},
+        "schedulers": {f"{name}/{model}": scheduler.stats() for (name, model), scheduler in all_schedulers().items()},
+        # Current adaptive concurrency, requests in flight, throughput and p95 latency per model
+        "concurrency": {f"{name}/{model}": controller.stats() for (name, model), controller in all_controllers().items()},
+    }
@@ -1,48 +1,23 @@
 import streamlit as st
-import google.generativeai as genai
-import google.ai.generativelanguage as glm
+import pandas as pd
 import re
 import time
+import uuid
 
 from backend.extract import process_document, save_to_excel
 from backend.filter import tag_policy_element
-from backend.extract_by_label import process_document_with_labels
+from backend.dedup import dedupe_policies, explode_policies
+from backend.policy_index import get_policy_index, index_extracted_policies
+from backend.extract_by_label import (build_label_index, filter_label_index, label_index_summary, load_label_chunks,
+                                      process_document_with_labels)
+from backend.llm import BACKENDS, DEFAULT_BACKEND
+from backend.outline import build_chapter_map, format_chapter, pages_for_chapters
+from backend.rag import DEFAULT_CORPUS, EXAMPLE_CORPORA
+from backend.chatbot import SessionIndex, answer_question
+from backend.spool import SpooledUpload
 
 ##################################################################
-# Set up Gemini API
-
-GOOGLE_API_KEY= st.secrets['GOOGLE_API_KEY']
-
-genai.configure(api_key=GOOGLE_API_KEY)
-
-##################################################################
-
-# model config
-generation_config = {
-"temperature": 0.9,
-"top_p": 1,
-"top_k": 1,
-"max_output_tokens": 2048,
-}
-
-safety_settings = [
-{
-    "category": "HARM_CATEGORY_HARASSMENT",
-    "threshold": "BLOCK_ONLY_HIGH"
-},
-{
-    "category": "HARM_CATEGORY_HATE_SPEECH",
-    "threshold": "BLOCK_ONLY_HIGH"
-},
-{
-    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-    "threshold": "BLOCK_ONLY_HIGH"
-},
-{
-    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-    "threshold": "BLOCK_ONLY_HIGH"
-},
-]
+# Gemini API key and model setup live in backend/llm.py
 
 ##################################################################
 # Set up page layout and title
@@ -80,6 +55,29 @@ with c2:
 if not "valid_inputs_received" in st.session_state:
     st.session_state["valid_inputs_received"] = False
 
+# Identifies this browser session to the shared LLM scheduler (fair share of the quota)
+if not "session_id" in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+
+
+# Uploads are copied to a temp file once per upload (not on every rerun) and
+# every reader opens that file by path, see backend/spool.py
+def spool_upload(uploaded_file, key):
+    spooled = st.session_state.get(key)
+    if uploaded_file is None:
+        if spooled is not None:
+            spooled.close()
+            del st.session_state[key]
+        return None
+
+    upload_id = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+    if spooled is None or spooled.source_id != upload_id:
+        if spooled is not None:
+            spooled.close()
+        spooled = SpooledUpload(uploaded_file, name=uploaded_file.name, source_id=upload_id)
+        st.session_state[key] = spooled
+    return spooled
+
 
 ##################################################################
 # Sidebar
@@ -109,7 +107,7 @@ with st.sidebar:
             You can:
             - See every extracted policy
             - 🔥 **Focus on wildfire-related content** (in progress)
-            - 💬 Ask custom questions (in progress)
+            - 💬 Ask custom questions about extracted policies
     """
                 )
 
@@ -132,7 +130,7 @@ st.markdown(
 # TABBED INTERFACE
 
 # Create tabs for the following sections:
-StartTab, ExtractLabelTab, FilteringTab, AboutTab = st.tabs(["Quick Start", "Extract By Label", "Filtering", "About"])
+StartTab, ExtractLabelTab, FilteringTab, SearchTab, AskTab, AboutTab = st.tabs(["Quick Start", "Extract By Label", "Filtering", "Policy Search", "Ask Questions", "About"])
 
 ##################################################################
 
@@ -182,17 +180,64 @@ with StartTab:
     """)
 
     st.warning("Please click the “Drag and Drop” button to upload a planning document.", icon="🤖")
-    model = genai.GenerativeModel(model_name="gemini-2.0-flash",
-                                generation_config=generation_config,
-                                safety_settings=safety_settings)
 
-    doc = st.file_uploader("Choose a file (PDF, DOCX, or TXT)", type=["pdf", "docx", "txt"], key="file_uploader_generic")
+    # Pick the model backend for this job (local backend has no per-minute quota)
+    backend_name = st.selectbox("Model backend", options=list(BACKENDS),
+                                index=list(BACKENDS).index(DEFAULT_BACKEND), key="backend_generic")
 
-    # CODE FOR EXTRACTING POLICIES
+    # Cascade: cheap pass on every page, stronger model only for uncertain pages
+    use_cascade = st.checkbox("Cascade mode (escalate only uncertain pages to a stronger model)", key="cascade_generic")
+
+    # Section chunking packs whole sections/policies (across page breaks) into fewer requests
+    chunking = st.radio("Split document by:", options=["page", "section"], horizontal=True,
+                        format_func=lambda c: "Page" if c == "page" else "Section (headings and policy labels)",
+                        key="chunking_generic")
+
+    # Example policies used to prompt the model (more corpora can be added under backend/corpora/)
+    corpus_name = st.selectbox("Example policy set", options=list(EXAMPLE_CORPORA),
+                               index=list(EXAMPLE_CORPORA).index(DEFAULT_CORPUS), key="corpus_generic")
+
+    # City is stored with every policy in the cross-city search index
+    city = st.text_input("(Optional) City or jurisdiction of this plan", key="city_generic")
+
+    doc = spool_upload(st.file_uploader("Choose a file (PDF, DOCX, or TXT)", type=["pdf", "docx", "txt"],
+                                        key="file_uploader_generic"), "spooled_generic")
+
+    # Chapters from the PDF outline (or printed table of contents) so users can skip irrelevant ones
+    start_extraction = False
+    selected_pages = None
     if doc:
-        df = process_document(doc)
+        # Read the outline once per upload, not on every rerun
+        if st.session_state.get("chapter_map_source") != doc.source_id:
+            st.session_state["chapter_map"] = build_chapter_map(doc) if doc.name.endswith(".pdf") else []
+            st.session_state["chapter_map_source"] = doc.source_id
+        chapter_map = st.session_state["chapter_map"]
+        if chapter_map:
+            selected_chapters = st.multiselect(
+                "(Optional) Only extract these chapters (leave empty for the whole document):",
+                options=[c["title"] for c in chapter_map],
+                format_func=lambda title: format_chapter(next(c for c in chapter_map if c["title"] == title)),
+                key="chapters_generic"
+            )
+            if selected_chapters:
+                selected_pages = pages_for_chapters(chapter_map, selected_chapters)
+        # Extraction only runs on click: other widgets and tabs rerun the script too
+        start_extraction = st.button("Extract policies", key="extract_generic")
+
+    # CODE FOR EXTRACTING POLICIES
+    if doc and start_extraction:
+        df = process_document(doc, backend=backend_name, cascade=use_cascade, chunking=chunking, pages=selected_pages,
+                              corpus=corpus_name, session=st.session_state["session_id"])
         st.session_state["df"] = df
 
+        # Add every extracted policy to the persistent cross-city search index
+        added = index_extracted_policies(df, city=city.strip(), document=doc.name)
+        if added:
+            st.caption(f"Added {added} policies to the Policy Search index.")
+
+    # Results stay on screen (and in the other tabs) across reruns until the next extraction
+    if isinstance(st.session_state.get("df"), pd.DataFrame) and not st.session_state["df"].empty:
+        df = st.session_state["df"]
         st.success("Extraction complete! Compare paragraph inputs with extracted policies:")
 
         # Helpful instructions before showing DataFrame
@@ -225,7 +270,7 @@ with FilteringTab:
 
     st.subheader("Filter Extracted Policies")
 
-    if "df" in st.session_state:
+    if isinstance(st.session_state.get("df"), pd.DataFrame) and not st.session_state["df"].empty:
         df = st.session_state["df"]
         df['Element'] = df['Extracted Policy'].apply(tag_policy_element)
         df = df.explode('Element').reset_index(drop=True)
@@ -292,10 +337,115 @@ with FilteringTab:
         #         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         #     )
 
-
     else:
         st.warning("Please upload and process a document in the Quick Start tab first.")
 
+    # Near-duplicates within one extraction, or across every plan in the search index
+    # (state templates and model ordinances repeat the same boilerplate city after city)
+    st.markdown("---")
+    st.subheader("Near-Duplicate Policies")
+    st.markdown("Plans repeat policies in summaries, implementation tables and appendices, and cities copy "
+                "the same template language. Split the results into one row per policy and group near-identical ones.")
+
+    dedup_sources = {}
+    if isinstance(st.session_state.get("df"), pd.DataFrame) and not st.session_state["df"].empty:
+        dedup_sources["Quick Start results"] = lambda: explode_policies(st.session_state["df"])
+    if isinstance(st.session_state.get("label_df"), pd.DataFrame) and not st.session_state["label_df"].empty:
+        dedup_sources["Extract By Label results"] = lambda: explode_policies(st.session_state["label_df"])
+    policy_index = get_policy_index()
+    if len(policy_index):
+        dedup_sources["All extracted plans"] = lambda: policy_index.to_dataframe(city=dedup_cities or None)
+
+    if not dedup_sources:
+        st.info("Nothing to compare yet. Extract a document first.")
+    else:
+        dedup_source = st.radio("Compare policies from:", options=list(dedup_sources), horizontal=True,
+                                key="dedup_source")
+        dedup_cities = []
+        if dedup_source == "All extracted plans":
+            dedup_cities = st.multiselect("(Optional) Only these cities:", options=policy_index.cities(),
+                                          key="dedup_cities")
+
+        if st.button("Group Duplicates"):
+            policies_df = dedupe_policies(dedup_sources[dedup_source]())
+            unique_df = policies_df[policies_df["Canonical"]]
+
+            st.success(f"Found {len(policies_df)} policies, {len(unique_df)} unique.")
+            if dedup_source == "All extracted plans":
+                # Groups that span several documents are the shared boilerplate
+                spread = policies_df.groupby("Duplicate Group")["Document"].transform("nunique")
+                st.caption(f"{int((spread[policies_df['Canonical']] > 1).sum())} groups appear in more than one plan.")
+            st.dataframe(unique_df, use_container_width=True)
+
+            st.download_button(
+                label="Download Unique Policies (.xlsx)",
+                data=save_to_excel(unique_df),
+                file_name="unique_policies.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+
+##################################################################
+# Policy Search Tab - "find policies like this one" across every extracted plan
+with SearchTab:
+
+    st.subheader("Search Policies Across Plans")
+
+    policy_index = get_policy_index()
+
+    if len(policy_index) == 0:
+        st.warning("The search index is empty. Extract policies in the Quick Start tab first.")
+    else:
+        st.markdown(f"Searching **{len(policy_index)}** policies from previously extracted plans.")
+
+        query = st.text_area("Paste a policy (or describe one) to find similar policies:", key="policy_search_query")
+        city_filter = st.multiselect("(Optional) Only these cities:", options=policy_index.cities(), key="policy_search_cities")
+        top_k = st.slider("Number of results", min_value=5, max_value=50, value=10, step=5, key="policy_search_k")
+
+        if st.button("Search") and query.strip():
+            matches = policy_index.search(query, k=top_k, city=city_filter or None)
+            if matches:
+                search_df = pd.DataFrame(matches)[["score", "city", "document", "page", "element", "policy"]]
+                search_df.columns = ["Similarity", "City", "Document", "Page #", "Element", "Policy"]
+                st.dataframe(search_df, use_container_width=True)
+            else:
+                st.warning("No similar policies found.")
+
+##################################################################
+# Ask Questions Tab - answers grounded in retrieved policies/pages, streamed
+with AskTab:
+
+    st.subheader("Ask About Extracted Policies")
+    st.markdown("Answers use only the most relevant extracted policies and pages, not the whole document.")
+
+    # Index the current extraction once per result table
+    session_index = None
+    if isinstance(st.session_state.get("df"), pd.DataFrame) and not st.session_state["df"].empty:
+        if st.session_state.get("qa_index_source") is not st.session_state["df"]:
+            st.session_state["qa_index"] = SessionIndex(st.session_state["df"])
+            st.session_state["qa_index_source"] = st.session_state["df"]
+        session_index = st.session_state["qa_index"]
+
+    include_corpus = st.checkbox("Also search policies from other extracted plans", value=session_index is None,
+                                 key="qa_include_corpus")
+    qa_backend_name = st.selectbox("Model backend", options=list(BACKENDS),
+                                   index=list(BACKENDS).index(DEFAULT_BACKEND), key="backend_qa")
+
+    question = st.text_input("Your question (e.g. 'What does the plan require for defensible space?')", key="qa_question")
+
+    if st.button("Ask") and question.strip():
+        answer_stream, context = answer_question(question, session_index, backend=qa_backend_name,
+                                                 include_corpus=include_corpus, session=st.session_state["session_id"])
+        answer_placeholder = st.empty()
+        answer = ""
+        for piece in answer_stream:
+            answer += piece
+            answer_placeholder.markdown(answer)
+
+        if context:
+            with st.expander(f"Sources ({len(context)})"):
+                for i, passage in enumerate(context, start=1):
+                    st.markdown(f"**[{i}]** {passage['source']}, page {passage['page']}: {passage['text']}")
+
 ##################################################################
 # Extract By Label
 with ExtractLabelTab:
@@ -374,21 +524,70 @@ with ExtractLabelTab:
     #     st.session_state.excluded_labels = ""
     #     st.experimental_rerun()
 
+    # Pick the model backend for this job (local backend has no per-minute quota)
+    label_backend_name = st.selectbox("Model backend", options=list(BACKENDS),
+                                      index=list(BACKENDS).index(DEFAULT_BACKEND), key="backend_for_label")
+
+    # Labels that start their own lines can be cut out without the model (no quota, seconds not minutes)
+    cut_locally = st.checkbox("Cut policies between labels directly, only ask the model about unclear pages",
+                              value=True, key="local_for_label")
+
     # Now prompt user to upload document
     st.warning("Now click the “Drag and Drop” button to upload your planning document: ", icon="🤖")
 
-    doc = st.file_uploader("Choose a file (PDF, DOCX, or TXT)", type=["pdf", "docx", "txt"], key="file_uploader_for_label")
+    doc = spool_upload(st.file_uploader("Choose a file (PDF, DOCX, or TXT)", type=["pdf", "docx", "txt"],
+                                        key="file_uploader_for_label"), "spooled_for_label")
+
+    # PRE-SCAN: find the labels page by page (regex only, no model calls) so they can be checked first
+    start_label_extraction = False
+    if doc and policy_labels:
+        # Read the document (OCR included) once per upload; editing the labels only reruns the regex
+        if st.session_state.get("label_chunks_source") != doc.source_id:
+            with st.spinner("Reading the document..."):
+                st.session_state["label_chunks"] = load_label_chunks(doc)
+            st.session_state["label_chunks_source"] = doc.source_id
+        scan_key = (doc.source_id, tuple(policy_labels), tuple(excluded_labels))
+        if st.session_state.get("label_scan_key") != scan_key:
+            st.session_state["label_index"] = build_label_index(doc, policy_labels, excluded_labels,
+                                                                loaded=st.session_state["label_chunks"])
+            st.session_state["label_scan_key"] = scan_key
+        label_index = st.session_state["label_index"]
+
+        st.markdown(f"**Label scan:** {len(label_index['pages'])} of {label_index['total']} {label_index['unit']} "
+                    f"contain at least one of your labels.")
+        st.dataframe(label_index_summary(label_index), use_container_width=True, hide_index=True)
+        if label_index["ocr_failures"]:
+            st.warning(f"OCR failed on {len(label_index['ocr_failures'])} scanned page(s): "
+                       f"{label_index['ocr_failures']}. Their labels can't be found. Is Tesseract installed?")
+        missing = [label for label, count in label_index["label_counts"].items() if not count]
+        if missing:
+            st.warning(f"No matches for: {', '.join(missing)}. Check the spelling/format, or edit the labels above.")
+
+        confirmed_labels = st.multiselect(
+            "Labels to extract (remove any that matched the wrong text):",
+            options=policy_labels,
+            default=[label for label in policy_labels if label_index["label_counts"][label]],
+            key="confirmed_labels"
+        )
+        label_index = filter_label_index(label_index, confirmed_labels)
+        if confirmed_labels and label_index["pages"]:
+            start_label_extraction = st.button(f"Extract policies from {len(label_index['pages'])} "
+                                               f"{label_index['unit']}", key="extract_for_label")
+    elif doc:
+        st.info("Enter at least one policy label above to scan the document.")
 
     # CODE FOR EXTRACTING POLICIES
-    if doc:
+    if doc and start_label_extraction:
 
-        if excluded_labels is None:
-            label_df = process_document_with_labels(doc, policy_labels)
-        else:
-            label_df = process_document_with_labels(doc, policy_labels, excluded_labels)
+        label_df = process_document_with_labels(doc, confirmed_labels, excluded_labels, backend=label_backend_name,
+                                                session=st.session_state["session_id"], label_index=label_index,
+                                                local=cut_locally)
 
         st.session_state["label_df"] = label_df
 
+    # Results stay on screen across reruns (download click, other tabs) until the next extraction
+    if isinstance(st.session_state.get("label_df"), pd.DataFrame) and not st.session_state["label_df"].empty:
+        label_df = st.session_state["label_df"]
         st.success("Extraction complete! Compare text page-by-page with extracted policies:")
 
         # Helpful instructions before showing DataFrame
@@ -414,10 +613,3 @@ with ExtractLabelTab:
             file_name="extracted_policies.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
-
-    
-
-
-
-
-
@@ -0,0 +1,109 @@
+import re
+
+import streamlit as st
+
+from backend.llm import get_backend, resolve_backend
+from backend.rag import build_rag_prompt, query_gemini_with_rag
+
+##################################################################
+# 1. Cascade settings
+#
+# Fast tier: the job's own backend (flash-lite or a local model).
+# Strong tier: only sees pages the fast tier is unsure about.
+
+STRONG_BACKEND = st.secrets.get("CASCADE_STRONG_BACKEND", "gemini")
+STRONG_MODEL = st.secrets.get("CASCADE_STRONG_MODEL", "gemini-2.5-flash")
+
+CONFIDENCE_THRESHOLD = 0.7   # escalate when the fast model reports less than this
+LONG_PAGE_CHARS = 6000       # very dense pages go straight to the strong tier
+MAX_SYMBOL_RATIO = 0.3       # share of non-word characters that marks a garbled page
+
+# Labels that usually introduce a policy, e.g. "Policy 6.2", "Goal LOC 2", "Program S-3"
+POLICY_LABEL_REGEX = re.compile(
+    r"\b(?:Policy|Policies|Goal|Program|Action|Objective|Implementation\s+Measure)\s+"
+    r"(?:[A-Z]{1,4}[\s-]?)?\d+(?:\.\d+)*",
+    re.IGNORECASE,
+)
+
+CONFIDENCE_REGEX = re.compile(r"^\s*CONFIDENCE\s*:\s*([01](?:\.\d+)?)\s*$", re.IGNORECASE | re.MULTILINE)
+
+##################################################################
+# 2. Fast pass prompt + response parsing
+
+def build_fast_prompt(page_text, corpus=None, element=None):
+    return build_rag_prompt(page_text, k=3, corpus=corpus, element=element) + """
+
+            After the policies, add one final line of the form
+            CONFIDENCE: <number between 0 and 1>
+            stating how confident you are that every policy on the page was extracted completely."""
+
+
+# input: raw fast-tier response
+# output: (response without the confidence line, confidence or None if missing)
+def parse_confidence(response):
+    matches = CONFIDENCE_REGEX.findall(response)
+    if not matches:
+        return response.strip(), None
+    text = CONFIDENCE_REGEX.sub("", response).strip()
+    return text, float(matches[-1])
+
+
+def count_policy_labels(text):
+    return len(set(m.group(0).lower() for m in POLICY_LABEL_REGEX.finditer(text)))
+
+##################################################################
+# 3. Escalation rules
+
+# input: page text, fast-tier policies and reported confidence
+# output: reason for escalation, or None if the fast answer is kept
+def escalation_reason(page_text, policy_text, confidence, threshold=CONFIDENCE_THRESHOLD):
+    if policy_text.startswith("Error:") or policy_text == "No response":
+        return "fast model error"
+    if confidence is None:
+        return "no confidence reported"
+    if confidence < threshold:
+        return f"low confidence ({confidence:.2f})"
+    if len(page_text) > LONG_PAGE_CHARS:
+        return "long page"
+
+    symbols = sum(1 for c in page_text if not (c.isalnum() or c.isspace()))
+    if page_text and symbols / len(page_text) > MAX_SYMBOL_RATIO:
+        return "malformed page text"
+
+    # Regex label count on the page vs. labels found in the extraction
+    page_labels = count_policy_labels(page_text)
+    found_labels = 0 if policy_text.strip().upper() == "NONE" else count_policy_labels(policy_text)
+    if found_labels < page_labels:
+        return f"label mismatch ({found_labels}/{page_labels} labels extracted)"
+
+    return None
+
+##################################################################
+# 4. Run one page through the cascade
+
+def get_strong_backend():
+    return get_backend(STRONG_BACKEND, STRONG_MODEL)
+
+
+# input: page text, fast and strong backends
+# output: dict with the final policy text, the tier that produced it and why it escalated
+def extract_with_cascade(page_text, fast_backend=None, strong_backend=None, threshold=CONFIDENCE_THRESHOLD,
+                         corpus=None, element=None):
+
+    from backend.extract import query_gemini
+
+    fast_backend = resolve_backend(fast_backend)
+    strong_backend = resolve_backend(strong_backend) if strong_backend is not None else get_strong_backend()
+
+    response = query_gemini(build_fast_prompt(page_text, corpus, element), backend=fast_backend)
+    policy_text, confidence = parse_confidence(response)
+
+    reason = escalation_reason(page_text, policy_text, confidence, threshold)
+    if reason is None:
+        return {"policy": policy_text, "model": fast_backend.model_name, "escalation": ""}
+
+    return {
+        "policy": query_gemini_with_rag(page_text, backend=strong_backend, corpus=corpus, element=element),
+        "model": strong_backend.model_name,
+        "escalation": reason,
+    }
@@ -1,62 +1,126 @@
-# RELEVANT CODE TO USER
-
-# prompt = st.chat_input("Ask a question or extract policies")
-
-# # Initialize previous_input_type in session_state if it doesn't exist
-# if "previous_input_type" not in st.session_state:
-#     st.session_state.previous_input_type = None
-
-# # Check if the input type has changed
-# if st.session_state.previous_input_type != add_radio:
-#     # Clear the messages
-#     st.session_state.messages = []
-#     # Update previous_input_type
-#     st.session_state.previous_input_type = add_radio
-
-# if "messages" not in st.session_state:
-#     st.session_state.messages = []
-
-# for message in st.session_state.messages:
-#     with st.chat_message(message["role"]):
-#         st.markdown(message["parts"][0])
-
-
-# if add_radio == 'Text ✏':
-#     model = genai.GenerativeModel(model_name="models/gemini-2.5-pro",
-#                                 generation_config=generation_config,
-#                                 safety_settings=safety_settings)
-#     prompt = st.chat_input("Ask anything")
-
-#     if prompt:
-#         message = prompt
-#         st.session_state.messages.append({
-#             "role":"user",
-#             "parts":[message],
-#         })
-#         with st.chat_message("user"):
-#             st.markdown(prompt)
-#         response = model.generate_content(st.session_state.messages)
-#         with st.chat_message("assistant"):
-#             message_placeholder = st.empty()
-#             message_placeholder.markdown(response.text)
-#         st.session_state.messages.append({
-#             "role":"model",
-#             "parts":[response.text],
-#         })
-
-            
-
-    # send to Gemini
-    # st.session_state.messages[{
-    #     "role":"user",
-    #     "parts":[full_prompt],
-    # }]
-    # with st.chat_message("user"):
-    #     st.markdown(prompt)
-    # response = model.generate_content(st.session_state.messages)
-    # with st.chat_message("assistant"):
-    #     st.markdown(response.text)
-    # st.session_state.messages.append({
-    #     "role":"model",
-    #     "parts":[response.text],
-    # })
\ No newline at end of file
+import faiss
+
+from backend.dedup import explode_policies
+from backend.llm import resolve_backend
+from backend.policy_index import get_policy_index
+from backend.rag import embed_texts
+from backend.ratelimit import PRIORITY_INTERACTIVE, scheduling, stream_with_retry
+
+##################################################################
+# 1. Q&A settings
+#
+# Questions are answered from a handful of retrieved policies/pages,
+# never from the whole document, so prompt size (and latency) stays
+# bounded however large the document or the corpus gets.
+
+TOP_K = 8                   # passages retrieved per question
+MAX_CONTEXT_CHARS = 6000    # hard cap on the context sent to the model
+PASSAGE_CHARS = 1200        # page text is split into passages of about this size
+
+##################################################################
+# 2. Local index over the current extraction
+
+def _split_passages(text, size=PASSAGE_CHARS):
+    text = " ".join(str(text).split())
+    return [text[i:i + size] for i in range(0, len(text), size)] if text else []
+
+
+class SessionIndex:
+
+    # input: extraction DataFrame (one row per page/chunk)
+    def __init__(self, df):
+        location_column = "Page #" if "Page #" in df.columns else "Location"
+        self.passages = []
+
+        # Individual policies first: short, precise answers
+        for _, row in explode_policies(df).iterrows():
+            self.passages.append({"kind": "policy", "page": row.get(location_column, ""), "text": row["Policy"]})
+
+        # Page text covers questions about context the extraction left out
+        for _, row in df.iterrows():
+            for passage in _split_passages(row.get("Page Text", "")):
+                self.passages.append({"kind": "page", "page": row.get(location_column, ""), "text": passage})
+
+        self.index = None
+        if self.passages:
+            embeddings = embed_texts(p["text"] for p in self.passages)
+            self.index = faiss.IndexFlatIP(embeddings.shape[1])
+            self.index.add(embeddings)
+
+    def search(self, question, k=TOP_K):
+        if self.index is None:
+            return []
+        scores, ids = self.index.search(embed_texts([question]), min(k, len(self.passages)))
+        return [{**self.passages[i], "score": float(s)} for s, i in zip(scores[0], ids[0]) if i >= 0]
+
+##################################################################
+# 3. Retrieval + compact prompt
+
+# input: question, optional SessionIndex for the current document, search other plans too?
+# output: retrieved passages, best first, trimmed to the context budget
+def retrieve_context(question, session_index=None, include_corpus=True, k=TOP_K, max_chars=MAX_CONTEXT_CHARS):
+    passages = []
+    if session_index is not None:
+        passages.extend({**p, "source": "this document"} for p in session_index.search(question, k))
+    if include_corpus:
+        for row in get_policy_index().search(question, k):
+            passages.append({
+                "kind": "policy",
+                "page": row["page"],
+                "text": row["policy"],
+                "score": row["score"],
+                "source": " - ".join(part for part in (row["city"], row["document"]) if part) or "policy index",
+            })
+
+    passages.sort(key=lambda p: p["score"], reverse=True)
+
+    context = []
+    used = 0
+    for passage in passages:
+        if used + len(passage["text"]) > max_chars:
+            continue
+        context.append(passage)
+        used += len(passage["text"])
+        if len(context) == k:
+            break
+    return context
+
+
+def build_qa_prompt(question, context):
+    sources = "\n".join(
+        f"[{i + 1}] ({p['source']}, page {p['page']}) {p['text']}" for i, p in enumerate(context)
+    )
+    return f"""You are a city planning policy expert.
+
+            Answer the question using ONLY the numbered excerpts below.
+            Cite the excerpts you use like [1] or [2].
+            If the excerpts do not contain the answer, say that the extracted policies don't cover it.
+
+            Excerpts:
+            {sources}
+
+            Question: {question}"""
+
+##################################################################
+# 4. Answer (streamed)
+
+# input: question, SessionIndex (or None), backend name/instance, session sharing the quota
+# output: (generator of answer pieces, passages used as context)
+def answer_question(question, session_index=None, backend=None, include_corpus=True, k=TOP_K, session=None):
+    context = retrieve_context(question, session_index, include_corpus, k)
+    backend = resolve_backend(backend)
+
+    def stream():
+        if not context:
+            yield "No extracted policies to answer from yet. Extract a document first."
+            return
+        prompt = build_qa_prompt(question, context)
+        try:
+            # Someone is waiting on the answer: always interactive priority. Same
+            # concurrency slot and 429 backoff/retry as extraction calls.
+            with scheduling(session, PRIORITY_INTERACTIVE):
+                yield from stream_with_retry(backend, lambda: backend.stream(prompt))
+        except Exception as e:
+            yield f"Error: {str(e)}"
+
+    return stream(), context
@@ -0,0 +1,327 @@
+import codecs
+import re
+from collections import Counter
+
+import docx
+
+from backend.spool import open_pdf, source_path
+
+##################################################################
+# 1. Chunker settings
+
+DEFAULT_MAX_TOKENS = 1500    # token ceiling per chunk sent to the LLM
+CHARS_PER_TOKEN = 4          # rough estimate, good enough for packing
+FONT_SAMPLE_PAGES = 30       # pages used to estimate the body font size
+HEADING_SIZE_RATIO = 1.15    # font size above body size * ratio => heading
+CHAPTER_SIZE_RATIO = 1.3     # larger headings can start a new element chapter
+
+# "Safety Element", "Land Use, Open Space and Conservation Element", "Chapter 5"
+CHAPTER_REGEX = re.compile(r"(\bElement\b|^\s*Chapter\s+[\dIVX]+\b)", re.IGNORECASE)
+
+# Plain text has no font sizes to go by: the whole line has to be the chapter name,
+# so "Policy S-1.1: Review the Safety Element every five years." isn't one
+TXT_CHAPTER_REGEX = re.compile(
+    r"^\s*(?:[\w,&'/ -]+\s+Element|Chapter\s+[\dIVX]+(?:\s*[:.-]?\s*[\w,&'/ -]+)?)\s*$",
+    re.IGNORECASE,
+)
+
+# Block starts with a policy/goal label, e.g. "Policy 6.2:", "GOAL LOC 2.", "Program S-3"
+LABEL_REGEX = re.compile(
+    r"^\s*(?:Policy|Goal|Program|Action|Objective|Implementation\s+Measure)\s+"
+    r"(?:[A-Z]{1,4}[\s-]?)?\d+(?:\.\d+)*",
+    re.IGNORECASE,
+)
+
+# Running headers/footers that shouldn't become content or headings
+NOISE_REGEX = re.compile(r"^\s*(Page\s+[A-Z]*-?\d+|[A-Z]*-?\d+|\d{4})\s*$", re.IGNORECASE)
+
+
+# 1-based page numbers to read: every page, or only the requested ones
+def page_range(doc, pages=None):
+    if pages is None:
+        return range(1, doc.page_count + 1)
+    return sorted(p for p in pages if 1 <= p <= doc.page_count)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+##################################################################
+# 2. Read blocks with font information
+
+# input: pymupdf page
+# output: list of text blocks with their largest font size and bold flag
+def page_blocks(page):
+    blocks = []
+    for block in page.get_text("dict")["blocks"]:
+        if block.get("type") != 0:  # skip image blocks
+            continue
+
+        lines = []
+        sizes = []
+        bold = True
+        for line in block["lines"]:
+            line_text = "".join(span["text"] for span in line["spans"]).strip()
+            if not line_text:
+                continue
+            lines.append(line_text)
+            for span in line["spans"]:
+                if span["text"].strip():
+                    sizes.append(round(span["size"], 1))
+                    bold = bold and bool(span["flags"] & 16)
+
+        text = " ".join(lines).strip()
+        if not text or NOISE_REGEX.match(text):
+            continue
+
+        blocks.append({
+            "text": text,
+            "size": max(sizes),
+            "bold": bold,
+            "y": block["bbox"][1],
+            "x": block["bbox"][0],
+        })
+
+    return sorted(blocks, key=lambda b: (b["y"], b["x"]))  # sort by y, then x
+
+
+# Most common font size weighted by characters => body text size
+def estimate_body_size(doc, sample_pages=FONT_SAMPLE_PAGES):
+    sizes = Counter()
+    for page_num in range(min(sample_pages, doc.page_count)):
+        for block in page_blocks(doc[page_num]):
+            sizes[block["size"]] += len(block["text"])
+    return sizes.most_common(1)[0][0] if sizes else 10.0
+
+
+# input: block, body font size
+# output: "chapter", "heading", "label" or "body"
+def classify_block(block, body_size):
+    text = block["text"]
+    is_large = block["size"] >= body_size * HEADING_SIZE_RATIO
+    is_short = len(text) < 120 and not text.endswith(".")
+
+    if block["size"] >= body_size * CHAPTER_SIZE_RATIO and CHAPTER_REGEX.search(text):
+        return "chapter"
+    if LABEL_REGEX.match(text):
+        return "label"
+    if is_large or (block["bold"] and is_short):
+        return "heading"
+    return "body"
+
+##################################################################
+# 3. Pack blocks into section-aware chunks
+#
+# Every reader (PDF pages, PDF sections, DOCX, TXT) emits the same record:
+#   page_num / page_end  pages covered (None for DOCX/TXT)
+#   locator              where the chunk came from: 3, "3-4", "¶ 12-18", "lines 40-75"
+#   section              chapter/heading path, "" if unknown
+#   text
+# Section readers (PDF sections, DOCX, TXT) also set "chapter": the element
+# chapter the chunk belongs to ("Safety Element"), "" if none was detected.
+
+def make_record(text, locator, section="", page_num=None, page_end=None):
+    return {
+        "page_num": page_num,
+        "page_end": page_end if page_end is not None else page_num,
+        "locator": locator,
+        "section": section,
+        "text": text,
+    }
+
+
+def _make_chunk(blocks):
+    chunk = make_record(
+        "\n".join(b["text"] for b in blocks),
+        locator=None,
+        section=" > ".join(part for part in (blocks[0]["chapter"], blocks[0]["heading"]) if part),
+        page_num=blocks[0]["page_num"],
+        page_end=blocks[-1]["page_num"],
+    )
+    chunk["chapter"] = blocks[0]["chapter"]
+    chunk["heading"] = blocks[0]["heading"]
+    chunk["locator"] = format_page_span(chunk)
+    return chunk
+
+
+# input: pdf file object, token ceiling per chunk, optional set of page numbers to read
+# output: list of chunk records (plus chapter, heading)
+#         scanned pages (images, no text layer) are appended to scanned_pages for the OCR lane
+#
+# Chunks never split a block, always break at element chapters, break at
+# headings once a chunk has some content, and when the ceiling is hit they
+# break before the last policy/goal label so a policy stays in one piece.
+def extract_section_chunks(file_obj, max_tokens=DEFAULT_MAX_TOKENS, min_tokens=None, pages=None, scanned_pages=None):
+
+    doc = open_pdf(file_obj)
+    body_size = estimate_body_size(doc)
+    min_tokens = max_tokens // 4 if min_tokens is None else min_tokens
+
+    chunks = []
+    current = []          # blocks in the chunk being built
+    current_tokens = 0
+    chapter = ""
+    heading = ""
+
+    def flush(upto=None):
+        nonlocal current, current_tokens
+        upto = len(current) if upto is None else upto
+        # Only headings so far: carry them into the next chunk instead of sending them alone
+        if not any(b["kind"] in ("label", "body") for b in current[:upto]):
+            return
+        chunks.append(_make_chunk(current[:upto]))
+        current = current[upto:]
+        current_tokens = sum(estimate_tokens(b["text"]) for b in current)
+
+    for page_num in page_range(doc, pages):
+        page = doc[page_num - 1]
+        blocks = page_blocks(page)
+        if not blocks and scanned_pages is not None and page.get_images(full=False):
+            scanned_pages.append(page_num)
+
+        for block in blocks:
+            kind = classify_block(block, body_size)
+            tokens = estimate_tokens(block["text"])
+
+            if kind == "chapter":
+                flush()
+                chapter, heading = block["text"], ""
+            elif kind == "heading":
+                if current_tokens >= min_tokens:
+                    flush()
+                heading = block["text"]
+
+            if current and current_tokens + tokens > max_tokens:
+                # Break before the last label so the policy being built moves as a whole
+                label_positions = [i for i, b in enumerate(current) if b["kind"] == "label" and i > 0]
+                if label_positions:
+                    flush(label_positions[-1])
+                if current_tokens + tokens > max_tokens:
+                    flush()
+
+            block.update({"kind": kind, "page_num": page_num, "chapter": chapter, "heading": heading})
+            current.append(block)
+            current_tokens += tokens
+
+    if current:
+        chunks.append(_make_chunk(current))
+
+    return chunks
+
+
+# "3" for single-page chunks, "3-4" when a chunk spans a page break
+def format_page_span(chunk):
+    if chunk.get("page_end", chunk["page_num"]) == chunk["page_num"]:
+        return chunk["page_num"]
+    return f"{chunk['page_num']}-{chunk['page_end']}"
+
+
+##################################################################
+# 4. DOCX and TXT chunks (same records, paragraph/line locators instead of pages)
+
+# Paragraph range under the current heading path, e.g. "¶ 12-18"
+def _paragraph_locator(start, end):
+    return f"¶ {start}" if start == end else f"¶ {start}-{end}"
+
+
+# input: docx file object, token ceiling per chunk
+# output: generator of chunk records; breaks at Heading/Title styles and at the ceiling
+def iter_docx_chunks(file_obj, max_tokens=DEFAULT_MAX_TOKENS):
+    doc_obj = docx.Document(source_path(file_obj) or file_obj)
+
+    headings = []      # current heading path, one entry per heading level
+    current = []       # (paragraph number, text)
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            record = make_record("\n".join(text for _, text in current),
+                                 locator=_paragraph_locator(current[0][0], current[-1][0]),
+                                 section=" > ".join(headings))
+            # Title/Heading 1 is often the plan name or a short heading, not an element
+            record["chapter"] = next((h for h in headings if CHAPTER_REGEX.search(h)), "")
+            yield record
+        current, current_tokens = [], 0
+
+    for para_num, para in enumerate(doc_obj.paragraphs, start=1):
+        text = para.text.strip()
+        if not text:
+            continue
+
+        style = para.style.name if para.style is not None else ""
+        if style == "Title" or style.startswith("Heading"):
+            yield from flush()
+            level = int(style.split()[-1]) if style.split()[-1].isdigit() else 1
+            headings = headings[:level - 1] + [text]
+            continue
+
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > max_tokens:
+            yield from flush()
+        current.append((para_num, text))
+        current_tokens += tokens
+
+    yield from flush()
+
+
+# Blank-line separated paragraphs as (first line, last line, text)
+def _iter_txt_paragraphs(lines):
+    paragraph = []
+    start = None
+    for line_num, line in enumerate(lines, start=1):
+        line = line.rstrip()
+        if line.strip():
+            if not paragraph:
+                start = line_num
+            paragraph.append(line)
+        elif paragraph:
+            yield start, start + len(paragraph) - 1, "\n".join(paragraph)
+            paragraph = []
+    if paragraph:
+        yield start, start + len(paragraph) - 1, "\n".join(paragraph)
+
+
+# input: txt file object (bytes) or spooled upload, token ceiling per chunk
+# output: generator of chunk records; the file is decoded line by line instead
+#         of read into one string, chapter-like lines ("Safety Element") start a new chunk
+def iter_txt_chunks(file_obj, max_tokens=DEFAULT_MAX_TOKENS, encoding="utf-8"):
+    path = source_path(file_obj)
+    if path:
+        with open(path, "rb") as f:
+            yield from iter_txt_chunks(f, max_tokens, encoding)
+        return
+    if hasattr(file_obj, "seek"):
+        file_obj.seek(0)
+    reader = codecs.getreader(encoding)(file_obj, errors="replace")
+
+    section = ""
+    current = []       # (first line, last line, text, is chapter heading)
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        # Only chapter headings so far: carry them into the next chunk instead of sending them alone
+        if all(is_chapter for _, _, _, is_chapter in current):
+            return
+        record = make_record("\n\n".join(text for _, _, text, _ in current),
+                             locator=f"lines {current[0][0]}-{current[-1][1]}",
+                             section=section)
+        # The section only ever comes from a chapter line
+        record["chapter"] = section
+        yield record
+        current, current_tokens = [], 0
+
+    for start, end, text in _iter_txt_paragraphs(reader):
+        is_chapter = start == end and len(text) < 120 and bool(TXT_CHAPTER_REGEX.match(text))
+        if is_chapter:
+            yield from flush()
+            section = text.strip()
+
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > max_tokens:
+            yield from flush()
+        current.append((start, end, text, is_chapter))
+        current_tokens += tokens
+
+    yield from flush()
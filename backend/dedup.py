@@ -0,0 +1,152 @@
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+##################################################################
+# 1. Dedup settings
+#
+# MinHash signatures + LSH banding: near-identical policies land in the same
+# bucket for at least one band, so we never compare every pair (no O(n²)).
+
+NUM_PERM = 64          # hash functions per signature
+BANDS = 16             # LSH bands (NUM_PERM / BANDS rows each)
+SHINGLE_SIZE = 3       # words per shingle
+SIMILARITY_THRESHOLD = 0.7
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(42)
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+
+# Columns carried from the page table onto each policy row
+METADATA_COLUMNS = ["City", "Document", "Page #", "Location", "Section"]
+
+# A new policy starts at a bullet, a number or a policy/goal label
+ITEM_START_REGEX = re.compile(
+    r"^\s*(?:[-*•]|\d+[.)]|(?:\*\*)?(?:Policy|Goal|Program|Action|Objective|Implementation\s+Measure)\b)",
+    re.IGNORECASE,
+)
+
+##################################################################
+# 2. One row per policy
+
+# input: extracted policy text for one page/chunk
+# output: list of individual policies
+def split_policies(text):
+    if not isinstance(text, str):
+        return []
+    text = text.strip()
+    if not text or text.upper() == "NONE" or text.startswith("Error:") or text == "No response":
+        return []
+
+    policies = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not policies or ITEM_START_REGEX.match(line):
+            policies.append(line)
+        else:
+            policies[-1] += " " + line  # continuation of the previous policy
+
+    # Drop a leading bullet ("- ", "* ", "• ") and markdown bold ("**Policy 6.1:**")
+    policies = [re.sub(r"^\s*(?:[-*]\s+|•\s*)", "", p).replace("**", "").strip() for p in policies]
+    return [p for p in policies if p]
+
+
+# input: extraction DataFrame (one row per page/chunk)
+# output: DataFrame with one row per policy and its page/section metadata
+def explode_policies(df, text_column="Extracted Policy"):
+    columns = [c for c in METADATA_COLUMNS if c in df.columns]
+    rows = []
+    for _, row in df.iterrows():
+        for policy in split_policies(row[text_column]):
+            new_row = {c: row[c] for c in columns}
+            new_row["Policy"] = policy
+            rows.append(new_row)
+    return pd.DataFrame(rows, columns=columns + ["Policy"])
+
+##################################################################
+# 3. MinHash signatures
+
+def normalize_policy(text):
+    return re.sub(r"[^a-z0-9 ]+", " ", text.lower()).split()
+
+
+def shingles(words, size=SHINGLE_SIZE):
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash_signature(text):
+    hashes = np.array([zlib.crc32(s.encode()) for s in shingles(normalize_policy(text))], dtype=np.uint64)
+    hashes %= _MERSENNE_PRIME
+    # (a * x + b) mod p for every permutation, minimum over shingles
+    permuted = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1)
+
+
+def estimated_similarity(sig_a, sig_b):
+    return float(np.mean(sig_a == sig_b))
+
+##################################################################
+# 4. Cluster near-duplicates
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+# input: list of policy texts
+# output: cluster id per policy (the index of the cluster's first policy)
+def cluster_near_duplicates(texts, threshold=SIMILARITY_THRESHOLD, bands=BANDS):
+    parent = list(range(len(texts)))
+    rows = NUM_PERM // bands
+
+    # Exact duplicates (after normalization) don't need hashing at all
+    first_seen = {}
+    to_hash = []
+    for i, text in enumerate(texts):
+        key = " ".join(normalize_policy(text))
+        if key in first_seen:
+            parent[i] = first_seen[key]
+        else:
+            first_seen[key] = i
+            to_hash.append(i)
+
+    signatures = {i: minhash_signature(texts[i]) for i in to_hash}
+
+    # LSH: each band hashes to a bucket; only bucket members are compared,
+    # and only against the bucket's first member, so big boilerplate buckets stay linear
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for i in to_hash:
+            buckets[signatures[i][band * rows:(band + 1) * rows].tobytes()].append(i)
+        for members in buckets.values():
+            head = members[0]
+            for i in members[1:]:
+                root_head, root_i = _find(parent, head), _find(parent, i)
+                if root_head != root_i and estimated_similarity(signatures[head], signatures[i]) >= threshold:
+                    parent[max(root_head, root_i)] = min(root_head, root_i)
+
+    return [_find(parent, i) for i in range(len(texts))]
+
+
+# input: DataFrame with one row per policy (see explode_policies)
+# output: same rows plus Duplicate Group, Copies and Canonical (first occurrence of its group)
+def dedupe_policies(policies_df, threshold=SIMILARITY_THRESHOLD, text_column="Policy"):
+    df = policies_df.reset_index(drop=True).copy()
+    clusters = cluster_near_duplicates(df[text_column].astype(str).tolist(), threshold)
+
+    # Number groups 1..n in order of first appearance
+    group_ids = {}
+    df["Duplicate Group"] = [group_ids.setdefault(c, len(group_ids) + 1) for c in clusters]
+    df["Copies"] = df.groupby("Duplicate Group")["Duplicate Group"].transform("size")
+    df["Canonical"] = ~df["Duplicate Group"].duplicated()
+    return df
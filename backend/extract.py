@@ -1,21 +1,23 @@
 from datetime import datetime
-import time
 import pandas as pd
 from typing import List, Dict
 
 import pdfplumber
-import docx
 import streamlit as st
-import google.generativeai as genai
 import io
-import pymupdf
 
+from backend.cascade import extract_with_cascade, get_strong_backend
+from backend.chunker import (DEFAULT_MAX_TOKENS, extract_section_chunks, iter_docx_chunks, iter_txt_chunks,
+                             make_record, page_range)
+from backend.llm import request_delay, resolve_backend
+from backend.ocr import iter_pages_with_ocr
+from backend.ratelimit import (RESPONSE_CACHE, admit_all, call_with_retry, get_controller, get_scheduler, map_concurrent,
+                              scheduled_job)
 from backend.rag import query_gemini_with_rag
+from backend.spool import open_pdf
 
 
-# 1. Configure Gemini API
-GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
-genai.configure(api_key=GOOGLE_API_KEY)
+# 1. LLM backend (Gemini, local OpenAI-compatible server or fake) lives in backend/llm.py
      
 
 # 2. Extract text from uploaded document (pdf / docx / txt)
@@ -24,7 +26,7 @@ genai.configure(api_key=GOOGLE_API_KEY)
 # Increase gap_threshold for larger paragraph chunks
 def extract_paragraphs_from_pdf(file_obj, gap_threshold=15):
 
-    doc = pymupdf.open(stream=file_obj, filetype="pdf")
+    doc = open_pdf(file_obj)
     paragraphs = []
 
     for page in doc:
@@ -58,130 +60,210 @@ def extract_paragraphs_from_pdf(file_obj, gap_threshold=15):
     return paragraphs
 
 # returns text page-by-page with corresponding page number
-def extract_text_with_page_numbers(file_obj):
-    doc = pymupdf.open(stream=file_obj, filetype="pdf")
-    page_texts = []
-
-    for page_num, page in enumerate(doc, start=1):
-        text = page.get_text("text").strip()
-        page_texts.append({
-            "page_num": page_num,
-            "text": text
-        })
-
-    return page_texts
-
-# input: doc path
-# output: list of paragraphs depending on format
-def extract_text(doc: str) -> List[str]:
-
-    para_chunks = []
+# pages: optional set of page numbers to read (e.g. selected chapters), others are skipped
+# scanned (image-only) pages are OCR'd instead of coming back empty
+def extract_text_with_page_numbers(file_obj, pages=None, ocr=True):
+    page_texts = [
+        {"page_num": p["page_num"], "text": p["text"]}
+        for p in iter_pages_with_ocr(file_obj, pages=pages, ocr=ocr)
+    ]
+    return sorted(page_texts, key=lambda p: p["page_num"])
+
+# input: uploaded doc (pdf / docx / txt), chunking mode for pdfs, token ceiling, optional pdf pages
+# output: (chunk records, number of chunks, unit name for progress messages)
+#
+# Every format yields the same chunk records (see backend/chunker.py), so the
+# rest of the pipeline doesn't care where the text came from.
+def load_chunks(doc, chunking="page", max_tokens=DEFAULT_MAX_TOKENS, pages=None):
 
     if doc.name.endswith(".pdf"):
-        # with pdfplumber.open(doc) as pdf:
-        #     for i, page in enumerate(pdf.pages):
-        #         text = page.extract_text()
-        #         if text:
-        #             paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        #             para_chunks.extend(paragraphs)
-        # Extract chunks by paragraph
-        # pdf_bytes = doc.read()
-        # pdf_obj = io.BytesIO(pdf_bytes)
-        # para_chunks = extract_paragraphs_from_pdf(pdf_obj)
-
-        # Extract chunks page-by-page
-        pdf_bytes = doc.read()
-        pdf_obj = io.BytesIO(pdf_bytes)
-
-        page_texts = extract_text_with_page_numbers(pdf_obj)
-        para_chunks = [(page["page_number"], page["text"]) for page in page_texts if page["text"]]
-        return para_chunks
-
+        if chunking == "section":
+            # Structure-aware chunks: complete sections/policies, may span page breaks
+            scanned_pages = []
+            chunks = extract_section_chunks(doc, max_tokens=max_tokens, pages=pages, scanned_pages=scanned_pages)
+
+            # Scanned pages have no text blocks to build sections from: OCR them and add them as page chunks
+            if scanned_pages:
+                for p in iter_pages_with_ocr(doc, pages=set(scanned_pages)):
+                    record = make_record(p["text"], locator=p["page_num"], page_num=p["page_num"])
+                    if p.get("ocr_error"):
+                        record["ocr_error"] = p["ocr_error"]
+                    chunks.append(record)
+                chunks.sort(key=lambda c: c["page_num"])
+            return chunks, len(chunks), "sections"
+
+        # Page-by-page. Text-layer pages flow straight to the model while
+        # scanned pages are OCR'd in a separate process pool and join as they finish
+        def stream_pages():
+            for p in iter_pages_with_ocr(doc, pages=pages):
+                record = make_record(p["text"], locator=p["page_num"], page_num=p["page_num"])
+                if p.get("ocr_error"):
+                    record["ocr_error"] = p["ocr_error"]
+                yield record
+
+        with open_pdf(doc) as pdf:
+            total_pages = len(page_range(pdf, pages))
+        return stream_pages(), total_pages, "pages"
 
     elif doc.name.endswith(".docx"):
-        doc_obj = docx.Document(doc)
-        para_chunks = [para.text.strip() for para in doc_obj.paragraphs if para.text.strip()]
-        return para_chunks
+        chunks = list(iter_docx_chunks(doc, max_tokens=max_tokens))
+        return chunks, len(chunks), "sections"
 
     elif doc.name.endswith(".txt"):
-        content = doc.read().decode()
-        paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
-        para_chunks = paragraphs
-        return para_chunks
+        chunks = list(iter_txt_chunks(doc, max_tokens=max_tokens))
+        return chunks, len(chunks), "sections"
 
     else:
         st.error("Unsupported file type.")
         st.stop()
+
+
+# input: doc path
+# output: list of chunk records depending on format
+def extract_text(doc) -> List[Dict]:
+    chunks, _, _ = load_chunks(doc)
+    return [chunk for chunk in chunks if chunk["text"]]
          
 
 # 3. Query Gemini with a text chunk
 
-# input: a paragraph
-# output: generated Gemini response
-def query_gemini(prompt):
+# input: a paragraph, optional backend (name or instance, defaults to LLM_BACKEND)
+# output: generated model response
+def query_gemini(prompt, backend=None):
+
+    backend = resolve_backend(backend)
 
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite")
+    # Identical prompts (re-runs, other users uploading the same plan) skip the quota
+    cache_key = RESPONSE_CACHE.key(backend, prompt)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
    
+    # One process-wide scheduler per model: every session and API tenant shares the quota.
+    # The controller caps requests in flight and learns the cap from latency and 429s.
+    # Rate limited calls back off (for everyone on this model) and retry instead of
+    # turning the page into an "Error:" row.
     try:
-        response = model.generate_content(prompt)
-        return response.text.strip() if response else "No response"
-    
+        response = call_with_retry(backend, lambda: backend.generate(prompt))
     except Exception as e:
         return f"Error: {str(e)}"
+    RESPONSE_CACHE.put(cache_key, response)
+    return response
      
 # 4. Process document by paragraph chunks (Iterate thru each paragrpah)
 
-# input: doc path
+# input: one chunk record, resolved backend(s) and options
+# output: one results row
+def extract_chunk(chunk, location_column, unit, backend, cascade=False, strong_backend=None, corpus=None):
+    para_text = chunk["text"]
+    row = {location_column: chunk["locator"]}
+    if unit != "pages":
+        row["Section"] = chunk["section"]
+    row["Page Text"] = para_text.strip()
+    # Chapter of a section chunk (e.g. "Safety Element") narrows the RAG examples; a plain heading
+    # ("Noise", "Use") would match the wrong element, so without a detected chapter use every example
+    element = chunk.get("chapter") or None
+
+    if cascade:
+        outcome = extract_with_cascade(para_text, backend, strong_backend, corpus=corpus, element=element)
+        row["Extracted Policy"] = outcome["policy"].strip()
+        row["Model"] = outcome["model"]
+        row["Escalation"] = outcome["escalation"]
+    else:
+        policy = query_gemini_with_rag(para_text, backend=backend, corpus=corpus, element=element) # use rag
+        row["Extracted Policy"] = policy.strip()
+    return row
+
+
+# input: chunk records from load_chunks, resolved backend(s) and options
+# output: generator of result rows, one per non-empty chunk, in chunk order (no Streamlit calls,
+#         also used by api.py); pages whose OCR failed are appended to ocr_failures
+#
+# Chunks are sent to the model concurrently, as many at once as the backend's
+# adaptive concurrency controller currently allows.
+def iter_extracted_rows(chunks, location_column, unit, backend, cascade=False, strong_backend=None,
+                        corpus=None, ocr_failures=None):
+
+    def non_empty():
+        for chunk in chunks:
+            if chunk.get("ocr_error") and ocr_failures is not None:
+                ocr_failures.append(chunk["page_num"])
+            if chunk["text"]:
+                yield chunk
+
+    def extract(chunk):
+        return extract_chunk(chunk, location_column, unit, backend, cascade, strong_backend, corpus)
+
+    yield from map_concurrent(extract, non_empty(), get_controller(backend))
+
+
+# PDFs are located by page, DOCX/TXT by paragraph or line range
+def location_column_for(doc):
+    return "Page #" if doc.name.endswith(".pdf") else "Location"
+
+
+# input: doc path, optional backend name for this job,
+#        cascade=True to run the backend as a cheap first pass and escalate uncertain pages,
+#        chunking="section" to follow headings/policy labels instead of raw pages,
+#        pages=set of page numbers to limit extraction to (e.g. chapters from the outline),
+#        corpus=example corpus used for RAG prompts (see backend/rag.py),
+#        session=id of the user/session sharing the quota (see backend/ratelimit.py)
 # output: dictionary of extracted policies
-def process_document(doc):
+def process_document(doc, backend=None, cascade=False, strong_backend=None,
+                     chunking="page", max_tokens=DEFAULT_MAX_TOKENS, pages=None, corpus=None, session=None):
 
     # text_chunks = extract_text(doc)
 
-    # Try extracting page-by-page
-    text_chunks = extract_text_with_page_numbers(doc)
-    page_chunks = [(p["page_num"], p["text"]) for p in text_chunks if p["text"]]
-    total_chunks = len(text_chunks)
+    chunks, total_chunks, unit = load_chunks(doc, chunking=chunking, max_tokens=max_tokens, pages=pages)
+    location_column = location_column_for(doc)
+    ocr_failures = []
     
-    # Gemini rate limit: 15 QPM → 1 query every 4 seconds
-    delay_per_chunk = 4.1  # Add slight buffer
+    # Gemini rate limit: 15 QPM → 1 query every 4 seconds (local backends don't wait).
+    # Pacing itself happens in query_gemini through the shared scheduler.
+    backend = resolve_backend(backend)
+    delay_per_chunk = request_delay(backend)
+    if cascade:
+        strong_backend = resolve_backend(strong_backend) if strong_backend is not None else get_strong_backend()
     estimated_time_sec = total_chunks * delay_per_chunk
     estimated_time_min = estimated_time_sec / 60
 
-    if total_chunks > 1000:
-        st.warning("Too many chunks for daily limit (1000/day). Consider splitting the document.")
-        return {}
+    # Admission control: don't start a job the daily quota (shared by every user) can't finish.
+    # A cascade may escalate every chunk, so the strong model's quota is reserved for all of them too.
+    scheduler = get_scheduler(backend)
+    schedulers = [scheduler, get_scheduler(strong_backend)] if cascade else [scheduler]
+    refused = admit_all(schedulers, session, total_chunks)
+    if refused is not None:
+        st.warning(f"Not enough daily quota left for {total_chunks} {unit} "
+                   f"({refused.remaining_today()} requests left today). Consider splitting the document.")
+        return pd.DataFrame()
 
     # Trying to read in pages instead of paragraphs. Change to paragraphs if needed
-    st.info(f"Reading {total_chunks} pages. Estimated processing time: ~{estimated_time_min:.1f} minutes.")
-
-    # extracted_policies = {}
-
-    # for i, para_text in enumerate(text_chunks):
-    #     st.write(f"Processing chunk {i+1}/{total_chunks}...")
-
-    #     extracted_policies[f"Chunk {i+1}"] = query_gemini(para_text)
-
-    #     if i < total_chunks - 1:
-    #         time.sleep(delay_per_chunk)
+    st.info(f"Reading {total_chunks} {unit}. Estimated processing time: ~{estimated_time_min:.1f} minutes.")
 
     results = []
 
     progress_bar = st.progress(0)
     progress_text = st.empty()
 
-    # Change back to --> for i, para_text in enumerate(text_chunks) if you don't want to go page-by-page
-    for i, (page_number,para_text) in enumerate(page_chunks):
-        # Trying to read in pages instead of paragraphs. Change to paragraphs if needed
-        progress_text.write(f"Processing page {i + 1}/{total_chunks}...")
-        policy = query_gemini_with_rag(para_text) # use rag
-        results.append({
-            "Page #": page_number,
-            "Page Text": para_text.strip(),
-            "Extracted Policy": policy.strip()
-        })
-        progress_bar.progress((i + 1) / total_chunks)
-        if i < total_chunks - 1:
-            time.sleep(delay_per_chunk)
+    with scheduled_job(schedulers, session, total_chunks):
+        rows = iter_extracted_rows(chunks, location_column, unit, backend, cascade, strong_backend, corpus, ocr_failures)
+        controller = get_controller(backend)
+        for i, row in enumerate(rows):
+            results.append(row)
+            stats = controller.stats()
+            progress_text.write(f"Processed {unit[:-1]} {i + 1}/{total_chunks}... "
+                                f"({stats['concurrency']} at a time, {stats['throughput_per_min']} requests/min)")
+            progress_bar.progress((i + 1) / total_chunks)
+
+    # OCR'd pages finish out of order: put rows back in page order
+    if unit == "pages":
+        results.sort(key=lambda r: r["Page #"])
+    if ocr_failures:
+        st.warning(f"OCR failed on {len(ocr_failures)} scanned page(s): {sorted(ocr_failures)}. Is Tesseract installed?")
+
+    if cascade and results:
+        escalated = sum(1 for r in results if r["Escalation"])
+        st.info(f"Cascade: {escalated}/{len(results)} {unit} escalated to {strong_backend.model_name}.")
 
     return pd.DataFrame(results)
 
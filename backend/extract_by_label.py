@@ -1,37 +1,28 @@
 from datetime import datetime
-import time
 import pandas as pd
 from typing import List, Dict
 
 import pdfplumber
 import docx
 import streamlit as st
-import google.generativeai as genai
-import io
-import pymupdf
 import re
+from collections import Counter
+
+from backend.extract import extract_text_with_page_numbers, load_chunks, location_column_for, query_gemini
+from backend.label_spans import (MAX_SPAN_CHARS, at_line_start, compile_label_regex, extract_label_spans,
+                                 find_policy_labels, page_edge_lines, running_lines)
+from backend.llm import request_delay, resolve_backend
+from backend.ratelimit import get_controller, get_scheduler, map_concurrent, scheduled_job
+from backend.spool import source_path
 
 ##################################################################
-# 1. Configure Gemini API
-GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
-genai.configure(api_key=GOOGLE_API_KEY)
+# 1. LLM backend (Gemini, local OpenAI-compatible server or fake) lives in backend/llm.py
 
 ##################################################################
 # 2. Extract text from uploaded document (pdf / docx / txt)
 
-# This function extracts pages from pdfs
-def extract_text_with_page_numbers(file_obj):
-    doc = pymupdf.open(stream=file_obj, filetype="pdf")
-    page_texts = []
-
-    for page_num, page in enumerate(doc, start=1):
-        text = page.get_text("text").strip()
-        page_texts.append({
-            "page_num": page_num,
-            "text": text
-        })
-
-    return page_texts
+# Pages are extracted with extract_text_with_page_numbers from backend/extract.py
+# (shared with the quick start tab, scanned pages are OCR'd instead of coming back empty)
 
 # This function cleans pages from pdfs
 def clean_page_text(page_text):
@@ -99,12 +90,10 @@ def extract_text(doc: str) -> List[str]:
         # pdf_obj = io.BytesIO(pdf_bytes)
         # para_chunks = extract_paragraphs_from_pdf(pdf_obj)
 
-        # Extract chunks page-by-page
-        pdf_bytes = doc.read()
-        pdf_obj = io.BytesIO(pdf_bytes)
+        # Extract chunks page-by-page (opened by path when the upload is spooled, no in-memory copy)
 
         # Step 1: Extract raw page texts
-        page_texts = extract_text_with_page_numbers(pdf_obj)
+        page_texts = extract_text_with_page_numbers(doc)
 
         # Step 2: Clean pages individually and create cleaned chunks
         cleaned_chunks = []
@@ -118,12 +107,16 @@ def extract_text(doc: str) -> List[str]:
 
 
     elif doc.name.endswith(".docx"):
-        doc_obj = docx.Document(doc)
+        doc_obj = docx.Document(source_path(doc) or doc)
         chunks = [para.text.strip() for para in doc_obj.paragraphs if para.text.strip()]
         return chunks
 
     elif doc.name.endswith(".txt"):
-        content = doc.read().decode()
+        if source_path(doc):
+            with open(source_path(doc), "rb") as f:
+                content = f.read().decode()
+        else:
+            content = doc.read().decode()
         paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
         chunks = paragraphs
         return chunks
@@ -133,47 +126,109 @@ def extract_text(doc: str) -> List[str]:
         st.stop()
 
 ##################################################################
-# 3. Find policy labels by doing a regex search
-
-# Generate a regex string
-def generate_broad_regex(s):
-    parts = re.findall(r'\w+|\d+(?:\.\d+)*|[^\w\s]+|\s+', s)
-    regex_parts = []
-    for part in parts:
-        if part.isspace():
-            regex_parts.append(r'\s+')
-        elif re.fullmatch(r'\d+(?:\.\d+)*', part):
-            regex_parts.append(r'\d+(?:\.\d+)*')
-        elif re.fullmatch(r'\w+', part):
-            regex_parts.append(r'\b' + re.escape(part) + r'\b')
-        elif part == "-":
-            # Allow dash OR space OR nothing
-            regex_parts.append(r'[-\s]?')
-        elif part == ":":
-            # Colon is optional
-            regex_parts.append(r'\:?')
-        else:
-            # Default: escape punctuation but allow optional space
-            regex_parts.append(re.escape(part))
-    return ''.join(regex_parts)
+# 3. Label regexes (find_policy_labels) and local span cutting (extract_label_spans) live in backend/label_spans.py
+
+##################################################################
+# 3b. Pre-scan: page -> labels index (regex only, no LLM calls)
+
+# input: doc
+# output: (chunk records as a list, total, unit), read (and OCR'd) once so that
+#         editing the labels only reruns the regex, see build_label_index
+def load_label_chunks(doc):
+    chunks, total_chunks, unit = load_chunks(doc)
+    return list(chunks), total_chunks, unit
+
+
+# input: doc, policy labels, optional excluded labels, optional load_label_chunks(doc) result
+# output: {"unit", "total", "pages", "heads", "running_lines", "label_counts", "label_pages", "ocr_failures"}
+#         pages: [{"locator", "seq", "text", "labels", "label_patterns", "boundaries"}] for pages with
+#         at least one policy label
+#         label_counts / label_pages: matches and pages per entered label (0 = label never matched)
+#
+# One pass over the document, so users can check their labels in seconds
+# and only the pages that matched are sent to the model afterwards.
+def build_label_index(doc, policy_labels, excluded_labels=None, loaded=None):
+    chunks, total_chunks, unit = loaded if loaded is not None else load_chunks(doc)
+    pattern = compile_label_regex(policy_labels)
+    excluded_pattern = compile_label_regex(excluded_labels)
+    label_counts = {label: 0 for label in policy_labels}
+    label_pages = {label: 0 for label in policy_labels}
+
+    pages = []
+    ocr_failures = []
+    heads = {}    # page -> text before its first label (continuation of the previous page's last policy)
+    edge_line_counts = Counter()    # top/bottom lines per page, to spot running headers/footers
+    for i, chunk in enumerate(chunks):
+        if chunk.get("ocr_error"):
+            ocr_failures.append(chunk["page_num"])
+        if not chunk["text"] or pattern is None:
+            continue
+        text = chunk["text"]
+        seq = chunk["locator"] if unit == "pages" else i
+
+        matched = {}
+        boundaries = []
+        for match in pattern.finditer(text):
+            label = policy_labels[int(match.lastgroup[len("label"):])]
+            label_counts[label] += 1
+            matched.setdefault(label, set()).add(match.group(0).strip())
+            if at_line_start(text, match.start()):
+                boundaries.append((match.start(), match.end(), match.group(0).strip(), label))
+        if excluded_pattern is not None:
+            boundaries.extend((m.start(), m.end(), m.group(0).strip(), None)
+                              for m in excluded_pattern.finditer(text) if at_line_start(text, m.start()))
+        boundaries.sort()
+
+        if unit == "pages":
+            edge_line_counts.update(page_edge_lines(text))
+            first = boundaries[0][0] if boundaries else len(text)
+            heads[seq] = text[:min(first, MAX_SPAN_CHARS + 1)]
+
+        if not matched:
+            continue
+        for label in matched:
+            label_pages[label] += 1
+        pages.append({
+            "locator": chunk["locator"],
+            "seq": seq,
+            "text": text,
+            "labels": sorted(set().union(*matched.values())),
+            "label_patterns": sorted(matched),
+            "boundaries": boundaries,
+        })
+
+    # OCR'd pages finish out of order
+    if unit == "pages":
+        pages.sort(key=lambda p: p["locator"])
+
+    return {"unit": unit, "total": total_chunks, "pages": pages, "heads": heads,
+            "running_lines": running_lines(edge_line_counts),
+            "label_counts": label_counts, "label_pages": label_pages, "ocr_failures": sorted(ocr_failures)}
+
 
-def find_policy_labels(text, label_patterns):
-    combined_regex = '|'.join(generate_broad_regex(label) for label in label_patterns)
-    pattern = re.compile(combined_regex, re.IGNORECASE)
-    matches = pattern.findall(text)
-    found_labels = sorted(set(match.strip() for match in matches))
-    return found_labels
+# Only the pages that contain at least one of the confirmed labels
+def filter_label_index(label_index, labels):
+    labels = set(labels)
+    pages = [p for p in label_index["pages"] if labels & set(p["label_patterns"])]
+    return {**label_index, "pages": pages}
+
+
+# input: label index
+# output: DataFrame with matches and pages per label, for review before extraction
+def label_index_summary(label_index):
+    return pd.DataFrame([
+        {"Label": label, "Matches": count, "Pages": label_index["label_pages"][label]}
+        for label, count in label_index["label_counts"].items()
+    ], columns=["Label", "Matches", "Pages"])
 
 ##################################################################
 # 4. Query Gemini by defining a policy based on user input (policy labels)
 
-def query_gemini_policy_labels(page_text, policy_labels, excluded_labels=None):
+def query_gemini_policy_labels(page_text, policy_labels, excluded_labels=None, backend=None):
 
     # labels_list = '\n'.join(f"- {label}" for label in policy_labels)
     labels_text = " | ".join(policy_labels)
 
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite")
-
     if excluded_labels is None:
         prompt = f"""You are a city planning policy expert.
                 The following page contains policies introduced
@@ -205,66 +260,122 @@ def query_gemini_policy_labels(page_text, policy_labels, excluded_labels=None):
                 Page: {page_text}
                 """
    
-    try:
-        response = model.generate_content(prompt)
-        return response.text.strip() if response else "No response"
-    
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return query_gemini(prompt, backend=backend)
     
 ##################################################################
 # 5. Run the prompt on the document
 
-def process_document_with_labels(doc, policy_labels, excluded_labels=None):
+# input: one (locator, text) pair, labels, backend
+# output: result row, or None when the chunk has none of the labels
+def label_row(page_number, para_text, policy_labels, excluded_labels=None, backend=None, location_column="Page #"):
+    inclusive_labels = find_policy_labels(para_text, policy_labels)
 
-    # Try extracting page-by-page
-    text_chunks = extract_text_with_page_numbers(doc)
-    page_chunks = [(p["page_num"], p["text"]) for p in text_chunks if p["text"]]
-    total_chunks = len(text_chunks)
-    
-    # Gemini rate limit: 15 QPM → 1 query every 4 seconds
-    delay_per_chunk = 4.1  # Add slight buffer
+    if excluded_labels:
+        rejected_labels = find_policy_labels(para_text, excluded_labels)
+    else:
+        rejected_labels=None
+
+    if not inclusive_labels:
+        print("No policy labels found on this page.")
+        return None
+
+    policy = query_gemini_policy_labels(para_text, inclusive_labels, rejected_labels, backend=backend)
+    return {
+        location_column: page_number,
+        "Page Text": para_text.strip(),
+        "Extracted Policy": policy.strip()
+    }
+
+
+# input: label index, pages already cut locally ({locator: policies}), pages for the model, labels, backend
+# output: generator of result rows in page order (no Streamlit calls, also used by api.py);
+#         model pages are sent concurrently while local ones cost nothing
+def iter_label_index_rows(label_index, extracted, model_pages, policy_labels, excluded_labels=None, backend=None,
+                          location_column="Page #"):
+    backend = resolve_backend(backend)
+
+    def extract(page):
+        return label_row(page["locator"], page["text"], policy_labels, excluded_labels, backend, location_column)
+
+    model_rows = map_concurrent(extract, model_pages, get_controller(backend))
+    for page in label_index["pages"]:
+        if page["locator"] in extracted:
+            yield {
+                location_column: page["locator"],
+                "Page Text": page["text"].strip(),
+                "Extracted Policy": extracted[page["locator"]],
+                "Extracted By": "labels",
+            }
+        else:
+            row = next(model_rows)
+            if row is not None:
+                yield {**row, "Extracted By": backend.model_name}
+
+
+# input: doc, labels, backend, session sharing the quota,
+#        label_index from build_label_index (reviewed by the user); built here if not given,
+#        local=True to cut policies between labels locally and only send unclear pages to the model
+# output: DataFrame of extracted policies
+def process_document_with_labels(doc, policy_labels, excluded_labels=None, backend=None, session=None,
+                                 label_index=None, local=True):
+
+    # Page-by-page (DOCX/TXT come in as sections with a paragraph/line locator),
+    # but only the pages the pre-scan found labels on
+    if label_index is None:
+        label_index = build_label_index(doc, policy_labels, excluded_labels)
+        if label_index["ocr_failures"]:
+            st.warning(f"OCR failed on {len(label_index['ocr_failures'])} scanned page(s): "
+                       f"{label_index['ocr_failures']}. Is Tesseract installed?")
+    unit = label_index["unit"]
+    location_column = location_column_for(doc)
+
+    if not label_index["pages"]:
+        st.warning("None of the policy labels were found in this document. Check the label format.")
+        return pd.DataFrame()
+
+    if local:
+        extracted, model_pages = extract_label_spans(label_index, policy_labels)
+    else:
+        extracted, model_pages = {}, label_index["pages"]
+    total_chunks = len(model_pages)
+
+    # Gemini rate limit: 15 QPM → 1 query every 4 seconds (local backends don't wait).
+    # Pacing itself happens in query_gemini through the shared scheduler.
+    backend = resolve_backend(backend)
+    delay_per_chunk = request_delay(backend)
     estimated_time_sec = total_chunks * delay_per_chunk
     estimated_time_min = estimated_time_sec / 60
 
-    if total_chunks > 1000:
-        st.warning("Too many chunks for daily limit (1000/day). Consider splitting the document.")
-        return {}
+    # Admission control: don't start a job the daily quota (shared by every user) can't finish
+    scheduler = get_scheduler(backend)
+    if not scheduler.admit(session, total_chunks):
+        st.warning(f"Not enough daily quota left for {total_chunks} {unit} "
+                   f"({scheduler.remaining_today()} requests left today). Consider splitting the document.")
+        return pd.DataFrame()
 
-    # Trying to read in pages instead of paragraphs. Change to paragraphs if needed
-    st.info(f"Reading {total_chunks} pages. Estimated processing time: ~{estimated_time_min:.1f} minutes.")
+    if extracted:
+        st.info(f"Cut policies between labels on {len(extracted)} {unit} without the model.")
+    if total_chunks:
+        st.info(f"Sending {total_chunks} of {label_index['total']} {unit} to the model. "
+                f"Estimated processing time: ~{estimated_time_min:.1f} minutes.")
 
     results = []
 
     progress_bar = st.progress(0)
     progress_text = st.empty()
+    total_pages = len(label_index["pages"])
 
-    # Change back to --> for i, para_text in enumerate(text_chunks) if you don't want to go page-by-page
-    for i, (page_number,para_text) in enumerate(page_chunks):
-        # Trying to read in pages instead of paragraphs. Change to paragraphs if needed
-        progress_text.write(f"Processing page {i + 1}/{total_chunks}...")
-        inclusive_labels = find_policy_labels(para_text, policy_labels)
-
-        if excluded_labels is not None:
-            rejected_labels = find_policy_labels(para_text, excluded_labels)
-        else:
-            rejected_labels=None
+    with scheduled_job(scheduler, session, total_chunks):
+        rows = iter_label_index_rows(label_index, extracted, model_pages, policy_labels, excluded_labels, backend,
+                                     location_column)
+        for i, row in enumerate(rows):
+            results.append(row)
+            progress_text.write(f"Processed {unit[:-1]} {i + 1}/{total_pages}...")
+            progress_bar.progress(min(1.0, (i + 1) / total_pages))
 
-        if not inclusive_labels:
-            print("No policy labels found on this page.")
-            continue
-
-        policy = query_gemini_policy_labels(para_text, inclusive_labels, rejected_labels) 
-        results.append({
-            "Page #": page_number,
-            "Page Text": para_text.strip(),
-            "Extracted Policy": policy.strip()
-        })
-        progress_bar.progress((i + 1) / total_chunks)
-        if i < total_chunks - 1:
-            time.sleep(delay_per_chunk)
+    progress_bar.progress(1.0)
 
     return pd.DataFrame(results)
 
 ##################################################################
-# END 
\ No newline at end of file
+# END 
@@ -0,0 +1,160 @@
+import re
+from functools import lru_cache
+
+from backend.chunker import NOISE_REGEX
+
+##################################################################
+# 1. Find policy labels by doing a regex search
+
+# Generate a regex string
+def generate_broad_regex(s):
+    parts = re.findall(r'\w+|\d+(?:\.\d+)*|[^\w\s]+|\s+', s)
+    regex_parts = []
+    for part in parts:
+        if part.isspace():
+            regex_parts.append(r'\s+')
+        elif re.fullmatch(r'\d+(?:\.\d+)*', part):
+            regex_parts.append(r'\d+(?:\.\d+)*')
+        elif re.fullmatch(r'\w+', part):
+            regex_parts.append(r'\b' + re.escape(part) + r'\b')
+        elif part == "-":
+            # Allow dash OR space OR nothing
+            regex_parts.append(r'[-\s]?')
+        elif part == ":":
+            # Colon is optional
+            regex_parts.append(r'\:?')
+        else:
+            # Default: escape punctuation but allow optional space
+            regex_parts.append(re.escape(part))
+    return ''.join(regex_parts)
+
+# Compiled once per label list (not once per page); each label gets a named
+# group so a match can be traced back to the label that produced it
+@lru_cache(maxsize=64)
+def _compile_labels(label_patterns):
+    if not label_patterns:
+        return None
+    combined_regex = '|'.join(f"(?P<label{i}>{generate_broad_regex(label)})" for i, label in enumerate(label_patterns))
+    return re.compile(combined_regex, re.IGNORECASE)
+
+
+def compile_label_regex(label_patterns):
+    return _compile_labels(tuple(label_patterns or ()))
+
+
+def find_policy_labels(text, label_patterns):
+    pattern = compile_label_regex(label_patterns)
+    if pattern is None:
+        return []
+    found_labels = sorted(set(match.group(0).strip() for match in pattern.finditer(text)))
+    return found_labels
+
+##################################################################
+# 2. Local span extraction (no LLM)
+#
+# When labels start their own lines ("Policy 6.2: ..."), a policy is simply
+# the text from its label to the next label, excluded label or chunk end,
+# plus the start of the next chunk when it runs over a page break. Pages
+# where that structure isn't clear go to the model instead.
+
+MAX_SPAN_CHARS = 3000    # a longer "policy" probably swallowed narrative text: ask the model
+MAX_CONTINUATION_CHARS = 400    # a longer page head is a new passage, not the end of a policy
+EDGE_LINES = 3                  # lines at the top/bottom of a page checked for running headers/footers
+RUNNING_LINE_MIN_PAGES = 3      # an edge line repeated on this many pages is a header/footer
+
+
+# Labels count as boundaries only at the start of a line (after an optional bullet),
+# so "consistent with Policy 6.2" in running text doesn't cut a policy in two
+def at_line_start(text, position):
+    line_start = text.rfind("\n", 0, position) + 1
+    return not text[line_start:position].strip(" \t•*-–")
+
+
+# Page numbers inside a running header ("Safety Element 6-12") don't make it a different line
+def _line_key(line):
+    return re.sub(r"\d+", "#", " ".join(line.split()).lower())
+
+
+# input: page text
+# output: keys of its first and last few lines, to be counted across pages
+def page_edge_lines(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    return {_line_key(line) for line in lines[:EDGE_LINES] + lines[-EDGE_LINES:]}
+
+
+# input: Counter of page_edge_lines over every page
+# output: keys of running headers/footers
+def running_lines(edge_line_counts, min_pages=RUNNING_LINE_MIN_PAGES):
+    return {key for key, count in edge_line_counts.items() if count >= min_pages}
+
+
+# Joins a span into one line, dropping page numbers and running headers/footers
+def _clean_span(text, running=()):
+    lines = [line for line in text.splitlines()
+             if line.strip() and not NOISE_REGEX.match(line) and _line_key(line) not in running]
+    return " ".join(" ".join(lines).split())
+
+
+# Text at the top of the next page that finishes a policy cut off by the page break,
+# "" when there is none, None when the page starts with something else (heading, intro)
+def _continuation(head, running=()):
+    head = _clean_span(head or "", running)
+    if not head:
+        return ""
+    if len(head) > MAX_CONTINUATION_CHARS or not head[0].islower():
+        return None
+    return head
+
+
+# input: label index from build_label_index, confirmed policy labels (others act as terminators)
+# output: ({locator: policies, one "- <label> <text>" line each}, pages the model has to handle)
+def extract_label_spans(label_index, policy_labels=None, max_chars=MAX_SPAN_CHARS):
+    confirmed = set(policy_labels) if policy_labels else None
+    heads = label_index["heads"]
+    running = label_index.get("running_lines", set())
+    extracted = {}
+    ambiguous = []
+
+    for page in label_index["pages"]:
+        text = page["text"]
+        boundaries = page["boundaries"]
+        starts = [b for b in boundaries if b[3] is not None and (confirmed is None or b[3] in confirmed)]
+
+        # Labels only in running text, or the same label twice (TOC, cross-reference list)
+        label_texts = [b[2].lower() for b in starts]
+        if not starts or len(set(label_texts)) < len(label_texts):
+            ambiguous.append(page)
+            continue
+
+        policies = []
+        for position, (start, end, label, pattern) in enumerate(boundaries):
+            if pattern is None or (confirmed is not None and pattern not in confirmed):
+                continue
+            if position + 1 < len(boundaries):
+                body = text[end:boundaries[position + 1][0]]
+            else:
+                # Last policy on a page stopping mid-sentence runs on into the next page,
+                # up to its first label (DOCX/TXT sections already end at headings).
+                # If the next page doesn't read as the rest of a sentence, the model decides.
+                body = text[end:]
+                if not _clean_span(body, running).endswith((".", ";", "!", "?", ")")):
+                    continuation = _continuation(heads.get(page["seq"] + 1), running)
+                    if continuation is None:
+                        policies = None
+                        break
+                    body += "\n" + continuation
+            body = _clean_span(body, running)
+            # Label entered without its colon ("Policy 1.1" matching "Policy 1.1: ...")
+            if body.startswith(":"):
+                label, body = label + ":", body[1:].lstrip()
+            if not body or len(body) > max_chars:
+                policies = None
+                break
+            policies.append(f"- {label} {body}")
+
+        if policies:
+            extracted[page["locator"]] = "\n".join(policies)
+        else:
+            ambiguous.append(page)
+
+    return extracted, ambiguous
@@ -0,0 +1,197 @@
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+import google.generativeai as genai
+
+##################################################################
+# 1. Configure Gemini API
+GOOGLE_API_KEY = st.secrets['GOOGLE_API_KEY']
+genai.configure(api_key=GOOGLE_API_KEY)
+
+DEFAULT_GEMINI_MODEL = "gemini-2.5-flash-lite"
+
+# Local OpenAI-compatible server (llama.cpp server, vLLM, ...)
+LOCAL_LLM_URL = st.secrets.get("LOCAL_LLM_URL", "http://localhost:8080/v1")
+LOCAL_LLM_MODEL = st.secrets.get("LOCAL_LLM_MODEL", "local-model")
+LOCAL_LLM_API_KEY = st.secrets.get("LOCAL_LLM_API_KEY", None)
+
+# Backend used when a job doesn't pick one
+DEFAULT_BACKEND = st.secrets.get("LLM_BACKEND", "gemini")
+
+# Gemini quota. Free tier: 15 QPM, 1000 a day. On paid tiers raise these (0 = no cap)
+# and let the adaptive concurrency controller find the real limit.
+GEMINI_REQUESTS_PER_MINUTE = st.secrets.get("GEMINI_REQUESTS_PER_MINUTE", 15) or None
+GEMINI_REQUESTS_PER_DAY = st.secrets.get("GEMINI_REQUESTS_PER_DAY", 1000) or None
+
+##################################################################
+# 2. Backends
+
+# Every backend exposes generate(prompt) -> str and raises on failure,
+# so callers decide how errors end up in the results table.
+class LLMBackend:
+    name = "base"
+    # None means no per-minute / per-day quota to respect (e.g. local inference)
+    requests_per_minute = None
+    requests_per_day = None
+    # Ceiling for requests in flight at once (the controller adapts below it)
+    max_concurrency = 4
+
+    def generate(self, prompt):
+        raise NotImplementedError
+
+    # Yields the answer in pieces as they arrive; backends without
+    # streaming just yield the whole answer at once.
+    def stream(self, prompt):
+        yield self.generate(prompt)
+
+
+# Google Gemini. The GenerativeModel (and its gRPC channel) is built once
+# and reused for every page instead of once per call.
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+    # Gemini rate limit: 15 QPM → 1 query every 4 seconds, 1000 queries a day (configurable above)
+    requests_per_minute = GEMINI_REQUESTS_PER_MINUTE
+    requests_per_day = GEMINI_REQUESTS_PER_DAY
+    max_concurrency = 8
+
+    def __init__(self, model_name=DEFAULT_GEMINI_MODEL, generation_config=None, safety_settings=None):
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name=model_name,
+                                           generation_config=generation_config,
+                                           safety_settings=safety_settings)
+
+    def generate(self, prompt):
+        response = self.model.generate_content(prompt)
+        return response.text.strip() if response else "No response"
+
+    def stream(self, prompt):
+        for chunk in self.model.generate_content(prompt, stream=True):
+            if chunk.parts:
+                yield chunk.text
+
+
+# Any server speaking the OpenAI chat completions API. A single
+# requests.Session keeps a pool of keep-alive connections to the server.
+class OpenAICompatibleBackend(LLMBackend):
+    name = "local"
+
+    def __init__(self, base_url=LOCAL_LLM_URL, model_name=LOCAL_LLM_MODEL, api_key=LOCAL_LLM_API_KEY,
+                 pool_size=8, timeout=300, temperature=0.0):
+        self.base_url = base_url.rstrip("/")
+        self.model_name = model_name
+        self.max_concurrency = pool_size
+        self.timeout = timeout
+        self.temperature = temperature
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def generate(self, prompt):
+        response = self.session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model_name,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": self.temperature,
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        choices = response.json().get("choices") or []
+        if not choices:
+            return "No response"
+        return (choices[0]["message"]["content"] or "").strip()
+
+    # Server-sent events: one "data: {json}" line per token batch, then "data: [DONE]"
+    def stream(self, prompt):
+        with self.session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": self.model_name,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": self.temperature,
+                "stream": True,
+            },
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                if choices and choices[0].get("delta", {}).get("content"):
+                    yield choices[0]["delta"]["content"]
+
+
+# Offline backend for trying out the pipeline without spending quota.
+# `response` can be a fixed string or a function of the prompt.
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, response="NONE", model_name="fake"):
+        self.response = response
+        self.model_name = model_name
+        self.prompts = []
+
+    def generate(self, prompt):
+        self.prompts.append(prompt)
+        if callable(self.response):
+            return self.response(prompt)
+        return self.response
+
+    def stream(self, prompt):
+        for word in self.generate(prompt).split(" "):
+            yield word + " "
+
+##################################################################
+# 3. Backend registry
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "local": OpenAICompatibleBackend,
+    "fake": FakeBackend,
+}
+
+_backend_cache = {}
+_backend_lock = threading.Lock()
+
+# input: backend name (gemini / local / fake) and optional model name
+# output: a shared backend instance, built once per process
+def get_backend(name=None, model_name=None):
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+
+    key = (name, model_name)
+    with _backend_lock:
+        if key not in _backend_cache:
+            kwargs = {"model_name": model_name} if model_name else {}
+            _backend_cache[key] = BACKENDS[name](**kwargs)
+        return _backend_cache[key]
+
+
+# input: backend name, backend instance or None
+# output: backend instance
+def resolve_backend(backend=None):
+    if backend is None or isinstance(backend, str):
+        return get_backend(backend)
+    return backend
+
+
+# Seconds to wait between calls so a job stays under the backend's quota
+def request_delay(backend):
+    qpm = resolve_backend(backend).requests_per_minute
+    if not qpm:
+        return 0.0
+    return 60 / qpm + 0.1  # Add slight buffer
@@ -0,0 +1,111 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pymupdf
+
+from backend.chunker import page_range
+from backend.spool import SpooledUpload, source_path
+
+##################################################################
+# 1. OCR settings
+#
+# Needs Tesseract (tesseract-ocr in packages.txt). PyMuPDF finds the
+# language data via the TESSDATA_PREFIX environment variable.
+
+OCR_LANGUAGE = "eng"
+OCR_DPI = 300
+OCR_WORKERS = 2
+
+##################################################################
+# 2. Scanned page detection + OCR of a single page
+
+# A page with no text layer but at least one image is a scan
+def is_image_only(page, text=None):
+    text = page.get_text("text") if text is None else text
+    return not text.strip() and bool(page.get_images(full=False))
+
+
+def ocr_page_text(page, language=OCR_LANGUAGE, dpi=OCR_DPI):
+    textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+    return page.get_text("text", textpage=textpage).strip()
+
+
+# Each worker process opens the document once, by path, and then only receives page numbers
+_worker_doc = None
+
+def _init_worker(pdf_path):
+    global _worker_doc
+    _worker_doc = pymupdf.open(pdf_path)
+
+
+def _ocr_worker(page_num, language, dpi):
+    try:
+        return page_num, ocr_page_text(_worker_doc[page_num - 1], language, dpi), None
+    except Exception as e:
+        return page_num, "", str(e)
+
+##################################################################
+# 3. Text-layer pages first, scanned pages from the OCR pool as they finish
+
+def _ocr_result(page_num, future):
+    try:
+        page_num, text, error = future.result()
+    except Exception as e:  # e.g. the worker process died
+        text, error = "", str(e)
+    page = {"page_num": page_num, "text": text, "ocr": True}
+    if error:
+        page["ocr_error"] = error
+    return page
+
+
+# input: pdf (spooled upload, path or file object), optional set of page numbers
+# output: generator of {page_num, text, ocr} dicts
+#
+# Pages with a text layer are yielded right away. Image-only pages are sent
+# to a separate process pool and yielded as soon as their OCR finishes, so
+# slow OCR never holds up the pages behind it. Pages therefore come out of
+# page order; callers sort by page_num when they need it.
+# Pages are read from disk one at a time; in-memory files are spooled first.
+def iter_pages_with_ocr(file_obj, pages=None, ocr=True, workers=OCR_WORKERS,
+                        language=OCR_LANGUAGE, dpi=OCR_DPI):
+
+    spooled = None
+    pdf_path = source_path(file_obj)
+    if pdf_path is None:
+        spooled = SpooledUpload(file_obj)
+        pdf_path = spooled.path
+    doc = pymupdf.open(pdf_path)
+
+    pool = None
+    pending = {}   # future -> page number
+
+    def finished():
+        done = [f for f in pending if f.done()]
+        return [_ocr_result(pending.pop(future), future) for future in done]
+
+    try:
+        for page_num in page_range(doc, pages):
+            page = doc[page_num - 1]
+            text = page.get_text("text").strip()
+
+            if ocr and is_image_only(page, text):
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=multiprocessing.get_context("spawn"),
+                                               initializer=_init_worker, initargs=(pdf_path,))
+                pending[pool.submit(_ocr_worker, page_num, language, dpi)] = page_num
+            else:
+                yield {"page_num": page_num, "text": text, "ocr": False}
+
+            yield from finished()
+
+        # Text layer done: wait for whatever OCR is still running
+        for future in as_completed(list(pending)):
+            yield _ocr_result(pending.pop(future), future)
+
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        doc.close()
+        if spooled is not None:
+            spooled.close()
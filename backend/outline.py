@@ -0,0 +1,133 @@
+import re
+from collections import Counter
+
+from backend.spool import open_pdf
+
+##################################################################
+# 1. Settings
+
+TOC_SCAN_PAGES = 15      # printed tables of contents are near the front
+MAX_PAGE_OFFSET = 60     # cover, front matter etc. before printed page 1
+
+# "Safety Element ........ 45", "3. Land Use Element   12"
+TOC_LINE_REGEX = re.compile(r"^(?P<title>.*?[A-Za-z].*?)[\s.·…_]{2,}(?P<page>\d{1,4})\s*$")
+TOC_PAGE_ONLY_REGEX = re.compile(r"^\s*(?P<page>\d{1,4})\s*$")
+
+# Entries that name a chapter of the plan rather than a subsection
+CHAPTER_TITLE_REGEX = re.compile(r"\bElement\b|^\s*Chapter\b|\bAppendix\b", re.IGNORECASE)
+
+##################################################################
+# 2. Chapters from the PDF outline (bookmarks)
+
+# input: open pymupdf document, outline level treated as a chapter
+# output: list of (title, first page) from the outline
+def read_outline_entries(doc, level=1):
+    entries = []
+    for lvl, title, page in doc.get_toc(simple=True):
+        if lvl <= level and page >= 1 and title.strip():
+            entries.append((title.strip(), page))
+    return entries
+
+##################################################################
+# 3. Chapters from a printed table of contents
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+# input: open pymupdf document
+# output: list of (title, printed page number) found on the first pages, TOC page numbers
+def parse_printed_toc(doc, scan_pages=TOC_SCAN_PAGES):
+    entries = []
+    toc_pages = set()
+    for page_num in range(min(scan_pages, doc.page_count)):
+        found = len(entries)
+        lines = [line.strip() for line in doc[page_num].get_text("text").splitlines() if line.strip()]
+        for i, line in enumerate(lines):
+            match = TOC_LINE_REGEX.match(line)
+            if match:
+                entries.append((match.group("title").strip(" .·…_"), int(match.group("page"))))
+                continue
+            # Title and page number extracted as separate lines
+            match = TOC_PAGE_ONLY_REGEX.match(line)
+            if match and i > 0 and not TOC_PAGE_ONLY_REGEX.match(lines[i - 1]) and len(lines[i - 1]) < 100:
+                entries.append((lines[i - 1].strip(" .·…_"), int(match.group("page"))))
+        if len(entries) > found:
+            toc_pages.add(page_num + 1)
+
+    # Keep chapter-level entries when the TOC lists them, otherwise everything
+    chapters = [e for e in entries if CHAPTER_TITLE_REGEX.search(e[0])]
+    return chapters or entries, toc_pages
+
+
+# Printed page numbers rarely match PDF page numbers (cover, front matter).
+# Vote on the offset that puts each title on the page it points to.
+def find_page_offset(doc, entries, toc_pages=(), max_offset=MAX_PAGE_OFFSET):
+    votes = Counter()
+    page_cache = {}
+    for title, printed_page in entries:
+        needle = _normalize(title)[:60]
+        for offset in range(0, max_offset + 1):
+            page_num = printed_page + offset
+            if page_num > doc.page_count:
+                break
+            if page_num in toc_pages:
+                continue
+            if page_num not in page_cache:
+                page_cache[page_num] = _normalize(doc[page_num - 1].get_text("text"))
+            if needle in page_cache[page_num]:
+                votes[offset] += 1
+                break
+    return votes.most_common(1)[0][0] if votes else 0
+
+##################################################################
+# 4. Chapter -> page range map
+
+# input: list of (title, first page), page count
+# output: list of chapters {title, start, end} with inclusive 1-based page ranges
+def entries_to_ranges(entries, page_count):
+    entries = sorted(set(e for e in entries if 1 <= e[1] <= page_count), key=lambda e: e[1])
+    chapters = []
+    for i, (title, start) in enumerate(entries):
+        next_start = entries[i + 1][1] if i + 1 < len(entries) else page_count + 1
+        chapters.append({
+            "title": title,
+            "start": start,
+            "end": max(start, next_start - 1),
+        })
+    return chapters
+
+
+# input: pdf (spooled upload, path or file object)
+# output: chapters {title, start, end, source} from the outline, else the printed TOC
+def build_chapter_map(file_obj, level=1):
+    doc = open_pdf(file_obj)
+
+    entries = read_outline_entries(doc, level)
+    source = "outline"
+    if not entries:
+        printed, toc_pages = parse_printed_toc(doc)
+        offset = find_page_offset(doc, printed, toc_pages)
+        entries = [(title, page + offset) for title, page in printed]
+        source = "toc"
+
+    chapters = entries_to_ranges(entries, doc.page_count)
+    for chapter in chapters:
+        chapter["source"] = source
+    return chapters
+
+
+# input: chapter map, titles picked by the user
+# output: set of page numbers to extract
+def pages_for_chapters(chapters, selected_titles):
+    pages = set()
+    for chapter in chapters:
+        if chapter["title"] in selected_titles:
+            pages.update(range(chapter["start"], chapter["end"] + 1))
+    return pages
+
+
+def format_chapter(chapter):
+    if chapter["start"] == chapter["end"]:
+        return f"{chapter['title']} (p. {chapter['start']})"
+    return f"{chapter['title']} (pp. {chapter['start']}-{chapter['end']})"
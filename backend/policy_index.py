@@ -0,0 +1,265 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+try:
+    import fcntl
+except ImportError:     # Windows: no file locks, so only one process may write to an index directory
+    fcntl = None
+
+from backend.dedup import explode_policies
+from backend.filter import tag_policy_element
+from backend.rag import embed_texts
+
+##################################################################
+# 1. Index settings
+#
+# Every extracted policy is embedded into one persistent HNSW index
+# (inner product over normalized vectors = cosine similarity). HNSW needs
+# no training step, so new documents are simply appended. Metadata rows
+# live next to the index in a JSONL file, row i <-> vector id i.
+#
+# The Streamlit app and the API can share one index directory: writers hold
+# an exclusive file lock and reload whatever the other process added before
+# appending; readers pick up new files under a shared lock.
+
+INDEX_DIR = st.secrets.get("POLICY_INDEX_DIR", "data/policy_index")
+HNSW_M = 32               # graph neighbours per node
+HNSW_EF_SEARCH = 64       # search breadth: higher = better recall, slower
+OVERFETCH = 5             # extra candidates fetched when filtering by metadata
+EXACT_FILTER_LIMIT = 20000  # filters matching fewer policies than this are searched exactly
+
+METADATA_FIELDS = ["tenant", "city", "document", "page", "section", "element", "policy"]
+
+##################################################################
+# 2. Embeddings come from backend/rag.py (embed_texts, normalized)
+
+# API tenants each get their own copy of a policy; the Streamlit app indexes as tenant ""
+def _policy_key(tenant, city, document, policy):
+    return (tenant or "", city or "", document or "", re.sub(r"\s+", " ", policy.lower()).strip())
+
+##################################################################
+# 3. Persistent index
+
+class PolicyIndex:
+
+    def __init__(self, directory=INDEX_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "policies.faiss")
+        self.metadata_path = os.path.join(directory, "policies.jsonl")
+        self.lock_path = os.path.join(directory, "policies.lock")
+        self.lock = threading.Lock()
+        self.index = None
+        self.metadata = []
+        self.keys = set()
+        self.version = None
+        with self._file_lock(exclusive=False):
+            self._load()
+
+    # Between processes; self.lock covers threads within one
+    @contextmanager
+    def _file_lock(self, exclusive):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            # Closing the file releases the lock
+            yield
+
+    def _index_version(self):
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Reload when another process replaced the index file since we read it (caller holds both locks)
+    def _refresh(self):
+        if self._index_version() != self.version:
+            self.index = None
+            self.metadata = []
+            self._load()
+
+    def _load(self):
+        self.version = self._index_version()
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+            self.index.hnsw.efSearch = HNSW_EF_SEARCH
+
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, "r") as f:
+                self.metadata = [json.loads(line) for line in f if line.strip()]
+
+        # A crash between the metadata append and the index write leaves extra rows
+        total = self.index.ntotal if self.index is not None else 0
+        if len(self.metadata) > total:
+            self.metadata = self.metadata[:total]
+            self._rewrite_metadata()
+
+        self.keys = {_policy_key(m.get("tenant"), m["city"], m["document"], m["policy"]) for m in self.metadata}
+
+    def _rewrite_metadata(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.metadata_path, "w") as f:
+            for row in self.metadata:
+                f.write(json.dumps(row) + "\n")
+
+    def __len__(self):
+        return len(self.metadata)
+
+    # input: list of metadata dicts (see METADATA_FIELDS)
+    # output: number of policies added (already indexed ones are skipped)
+    def add(self, rows):
+        with self.lock, self._file_lock(exclusive=True):
+            # Another process may have appended since we loaded: start from what is on disk
+            self._refresh()
+            new_rows = []
+            for row in rows:
+                key = _policy_key(row.get("tenant"), row.get("city"), row.get("document"), row["policy"])
+                if key not in self.keys:
+                    self.keys.add(key)
+                    new_rows.append({field: row.get(field, "") for field in METADATA_FIELDS})
+            if not new_rows:
+                return 0
+
+            embeddings = embed_texts(row["policy"] for row in new_rows)
+            if self.index is None:
+                self.index = faiss.IndexHNSWFlat(embeddings.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+                self.index.hnsw.efSearch = HNSW_EF_SEARCH
+            self.index.add(embeddings)
+
+            # Append metadata first, then replace the index file atomically
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.metadata_path, "a") as f:
+                for row in new_rows:
+                    f.write(json.dumps(row) + "\n")
+            faiss.write_index(self.index, self.index_path + ".tmp")
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.version = self._index_version()
+
+            self.metadata.extend(new_rows)
+            return len(new_rows)
+
+    # input: query text, number of results, optional metadata filters (exact match)
+    # output: list of metadata dicts with a similarity score, best first
+    def search(self, query, k=10, city=None, document=None, element=None):
+        query_embedding = embed_texts([query])
+
+        # Searches wait for a running add(): HNSW isn't safe to search while it grows,
+        # and metadata has to cover every id the index can return
+        with self.lock:
+            with self._file_lock(exclusive=False):
+                self._refresh()
+            if self.index is None or self.index.ntotal == 0:
+                return []
+
+            if not any(value for value in (city, document, element)):
+                scores, ids = self.index.search(query_embedding, min(k, self.index.ntotal))
+                return [{**self.metadata[i], "score": float(s)} for s, i in zip(scores[0], ids[0]) if i >= 0]
+
+            ids = [i for i, row in enumerate(self.metadata) if _matches(row, city, document, element)]
+            if not ids:
+                return []
+
+            # A few cities out of many: exact scores over just their policies
+            if len(ids) <= EXACT_FILTER_LIMIT:
+                return self._exact_search(query_embedding, ids, k)
+
+            # Broad filter: widen the graph search until k results pass it
+            fetch = min(self.index.ntotal, k * OVERFETCH)
+            while True:
+                scores, found = self.index.search(query_embedding, fetch)
+                results = [{**self.metadata[i], "score": float(s)} for s, i in zip(scores[0], found[0])
+                           if i >= 0 and _matches(self.metadata[i], city, document, element)]
+                if len(results) >= k:
+                    return results[:k]
+                # HNSW stops returning neighbours long before ntotal; finish exactly
+                if fetch >= self.index.ntotal:
+                    return self._exact_search(query_embedding, ids, k)
+                fetch = min(self.index.ntotal, fetch * 4)
+
+    # Exact inner products against the stored vectors of the given ids (caller holds the lock)
+    def _exact_search(self, query_embedding, ids, k):
+        ids = np.asarray(ids, dtype="int64")
+        scores = np.concatenate([
+            self.index.reconstruct_batch(ids[start:start + EXACT_FILTER_LIMIT]) @ query_embedding[0]
+            for start in range(0, len(ids), EXACT_FILTER_LIMIT)
+        ])
+        top = np.argsort(-scores)[:k]
+        return [{**self.metadata[ids[j]], "score": float(scores[j])} for j in top]
+
+    def cities(self):
+        return sorted({row["city"] for row in self.metadata if row["city"]})
+
+    # input: optional city filter, optional tenant (None = every tenant's policies)
+    # output: DataFrame with one row per indexed policy (same columns as explode_policies, plus Element)
+    def to_dataframe(self, city=None, tenant=None):
+        with self.lock:
+            with self._file_lock(exclusive=False):
+                self._refresh()
+            rows = [row for row in self.metadata if (not city or row["city"] in _as_list(city))
+                    and (tenant is None or row.get("tenant", "") == tenant)]
+        return pd.DataFrame({
+            "City": [row["city"] for row in rows],
+            "Document": [row["document"] for row in rows],
+            "Page #": [row["page"] for row in rows],
+            "Section": [row["section"] for row in rows],
+            "Element": [row["element"] for row in rows],
+            "Policy": [row["policy"] for row in rows],
+        })
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple, set)) else [value]
+
+
+def _matches(row, city=None, document=None, element=None):
+    if city and row["city"] not in _as_list(city):
+        return False
+    if document and row["document"] not in _as_list(document):
+        return False
+    if element and not set(_as_list(element)) & set(row["element"].split(", ")):
+        return False
+    return True
+
+##################################################################
+# 4. Shared instance + helpers
+
+_policy_index = None
+_policy_index_lock = threading.Lock()
+
+def get_policy_index():
+    global _policy_index
+    with _policy_index_lock:
+        if _policy_index is None:
+            _policy_index = PolicyIndex()
+        return _policy_index
+
+
+# input: extraction DataFrame, city and document name, API tenant that extracted it
+# output: number of new policies added to the persistent index
+def index_extracted_policies(df, city="", document="", tenant=""):
+    if df is None or len(df) == 0:
+        return 0
+
+    policies_df = explode_policies(df)
+    location_column = "Page #" if "Page #" in policies_df.columns else "Location"
+    rows = []
+    for _, row in policies_df.iterrows():
+        rows.append({
+            "tenant": tenant or "",
+            "city": city or "",
+            "document": document or "",
+            "page": str(row.get(location_column, "")),
+            "section": row.get("Section", "") or "",
+            "element": ", ".join(tag_policy_element(row["Policy"])),
+            "policy": row["Policy"],
+        })
+    return get_policy_index().add(rows)
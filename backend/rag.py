@@ -1,43 +1,132 @@
+
 from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import json
+import os
+import threading
 
 # Load embedding model
 embedder = SentenceTransformer("all-MiniLM-L6-v2")
 
-# Load wildfire example policies (list of dicts)
-with open("backend/atasc_gp_policies.json", "r") as f:
-    example_policies_json = json.load(f)
+##################################################################
+# Example corpora registry
+#
+# Each corpus is a JSON list of {"element", "goal", "policy", "policy_text"}.
+# Drop more example sets into backend/corpora/<name>.json, or call
+# register_corpus(), and they can be picked per job.
 
-# Format each policy dict into a string for embedding and retrieval, e.g. "Policy 1.1: ..."
-example_policies = [
-    f"{item['policy']}: {item['policy_text']}" for item in example_policies_json
-]
+CORPUS_DIR = "backend/corpora"
+DEFAULT_CORPUS = "atasc"
+EXAMPLE_CORPORA = {"atasc": "backend/atasc_gp_policies.json"}
 
-# Embed the formatted policy strings
-example_embeddings = embedder.encode(example_policies, convert_to_numpy=True)
+if os.path.isdir(CORPUS_DIR):
+    for file_name in sorted(os.listdir(CORPUS_DIR)):
+        if file_name.endswith(".json"):
+            EXAMPLE_CORPORA[file_name[:-len(".json")]] = os.path.join(CORPUS_DIR, file_name)
 
-# Create FAISS index
-dimension = example_embeddings.shape[1]
-index = faiss.IndexFlatL2(dimension)
-index.add(example_embeddings)
+# Exact search is fine for a few thousand examples; above that use HNSW
+LARGE_CORPUS_SIZE = 5000
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
 
 
-def retrieve_examples(paragraph, k=3):
-    para_embedding = embedder.encode([paragraph], convert_to_numpy=True)
-    distances, indices = index.search(para_embedding, k)
-    return [example_policies[i] for i in indices[0]]
+# input: list of texts
+# output: float32 matrix of unit-length embeddings (inner product = cosine similarity)
+def embed_texts(texts):
+    embeddings = embedder.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+    return np.asarray(embeddings, dtype="float32")
 
 
-def query_gemini_with_rag(paragraph):
+def _element_key(element):
+    return element.lower().replace("element", "").strip(" ,")
 
-    from backend.extract import query_gemini
 
-    examples = retrieve_examples(paragraph, k=3)
+class ExampleCorpus:
+
+    def __init__(self, name, path):
+        self.name = name
+        with open(path, "r") as f:
+            items = json.load(f)
+
+        # Format each policy dict into a string for embedding and retrieval, e.g. "Policy 1.1: ..."
+        self.examples = [f"{item['policy']}: {item['policy_text']}" for item in items]
+        self.elements = [item.get("element", "") for item in items]
+
+        self.embeddings = embed_texts(self.examples)
+        dimension = self.embeddings.shape[1]
+        if len(self.examples) >= LARGE_CORPUS_SIZE:
+            self.index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efSearch = HNSW_EF_SEARCH
+        else:
+            self.index = faiss.IndexFlatIP(dimension)
+        self.index.add(self.embeddings)
+
+        # element name -> example ids, for filtered retrieval
+        self.element_ids = {}
+        for i, element in enumerate(self.elements):
+            self.element_ids.setdefault(element, []).append(i)
+
+    # "Safety", "Safety Element" or "Chapter 7: Safety" all match "Safety and Noise Element"
+    def ids_for_element(self, element):
+        query = _element_key(element)
+        ids = []
+        for name, element_ids in self.element_ids.items():
+            key = _element_key(name)
+            if key and query and (query in key or key in query):
+                ids.extend(element_ids)
+        return np.array(sorted(ids), dtype="int64")
+
+    def retrieve(self, text, k=3, element=None):
+        query = embed_texts([text])
+
+        if element:
+            ids = self.ids_for_element(element)
+            if len(ids):
+                # Filtered search: exact scores over just this element's examples
+                scores = self.embeddings[ids] @ query[0]
+                top = ids[np.argsort(-scores)[:k]]
+                return [self.examples[i] for i in top]
+
+        k = min(k, len(self.examples))
+        scores, indices = self.index.search(query, k)
+        return [self.examples[i] for i in indices[0] if i >= 0]
+
+
+_corpora = {}
+_corpora_lock = threading.Lock()
+
+def register_corpus(name, path):
+    with _corpora_lock:
+        EXAMPLE_CORPORA[name] = path
+        _corpora.pop(name, None)
+
+
+# Corpora are embedded once, on first use
+def get_corpus(name=None):
+    name = name or DEFAULT_CORPUS
+    if name not in EXAMPLE_CORPORA:
+        raise ValueError(f"Unknown example corpus '{name}'. Choose from: {', '.join(EXAMPLE_CORPORA)}")
+    with _corpora_lock:
+        if name not in _corpora:
+            _corpora[name] = ExampleCorpus(name, EXAMPLE_CORPORA[name])
+        return _corpora[name]
+
+
+# Build the default corpus at import, as before
+get_corpus(DEFAULT_CORPUS)
+
+
+def retrieve_examples(paragraph, k=3, corpus=None, element=None):
+    return get_corpus(corpus).retrieve(paragraph, k=k, element=element)
+
+
+def build_rag_prompt(paragraph, k=3, corpus=None, element=None):
+
+    examples = retrieve_examples(paragraph, k=k, corpus=corpus, element=element)
     example_text = "\n".join(examples)
 
-    prompt = f"""You are a city planning policy expert.
+    return f"""You are a city planning policy expert.
 
             Below are real examples of policies: {example_text}
             Now, from the following page, extract ONLY policies.
@@ -47,5 +136,12 @@ def query_gemini_with_rag(paragraph):
             If no policies are present, respond with: NONE.
 
             Page: {paragraph}"""
-    
-    return query_gemini(prompt)  # Your existing function
+
+
+def query_gemini_with_rag(paragraph, backend=None, corpus=None, element=None):
+
+    from backend.extract import query_gemini
+
+    prompt = build_rag_prompt(paragraph, k=3, corpus=corpus, element=element)
+
+    return query_gemini(prompt, backend=backend)  # Your existing function
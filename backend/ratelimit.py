@@ -0,0 +1,455 @@
+import contextvars
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+##################################################################
+# 1. Shared scheduler
+#
+# One scheduler per backend/model for the whole process. Every Streamlit
+# session, API tenant and job draws from the same quota, so two users on
+# one API key can't double the real request rate the way independent
+# sleeps did. Within that quota:
+#   - priority classes: small interactive documents go ahead of bulk jobs
+#   - weighted fair sharing: within a class, sessions take turns in
+#     proportion to their weight (start-time fair queuing), so one
+#     500-page upload can't starve everyone else
+#   - admission control: a job is only started if the daily quota left
+#     (minus what running jobs already reserved) covers it
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+INTERACTIVE_MAX_CHUNKS = 25     # documents up to this many chunks count as interactive
+
+MAX_RETRIES = 4                 # retries after a 429/503 before giving up on a chunk
+BACKOFF_SECONDS = 5             # first retry waits this long, then doubles
+RETRYABLE_STATUS = (429, 503)
+
+DEFAULT_SESSION = "default"
+
+# (session, priority) of the job running in the current thread / context
+_scheduling = contextvars.ContextVar("llm_scheduling", default=(DEFAULT_SESSION, PRIORITY_INTERACTIVE))
+
+
+# Run a block of LLM calls on behalf of a session, e.g.
+#   with scheduling(session_id, priority_for(total_chunks)): ...
+@contextmanager
+def scheduling(session, priority=PRIORITY_INTERACTIVE):
+    token = _scheduling.set((session or DEFAULT_SESSION, priority))
+    try:
+        yield
+    finally:
+        _scheduling.reset(token)
+
+
+def current_scheduling():
+    return _scheduling.get()
+
+
+# Run an admitted job: its calls are queued under its session and priority class,
+# and its unused reservation is released when it ends (on every scheduler it was admitted on)
+@contextmanager
+def scheduled_job(scheduler, session, total_chunks):
+    schedulers = scheduler if isinstance(scheduler, (list, tuple)) else [scheduler]
+    try:
+        with scheduling(session, priority_for(total_chunks)):
+            yield
+    finally:
+        for scheduler in schedulers:
+            scheduler.release(session)
+
+
+# Admit one job on several schedulers (e.g. both models of a cascade): all or none
+# output: the scheduler that refused it, or None once every one has admitted it
+def admit_all(schedulers, session, requests):
+    admitted = []
+    for scheduler in schedulers:
+        if not scheduler.admit(session, requests):
+            for other in admitted:
+                other.release(session)
+            return scheduler
+        admitted.append(scheduler)
+    return None
+
+
+def priority_for(total_chunks):
+    return PRIORITY_INTERACTIVE if total_chunks <= INTERACTIVE_MAX_CHUNKS else PRIORITY_BATCH
+
+
+# Gemini raises google.api_core ResourceExhausted (code 429), requests raises HTTPError
+def is_rate_limit_error(e):
+    status = getattr(e, "code", None)
+    if status not in RETRYABLE_STATUS:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status in RETRYABLE_STATUS or "429" in str(e) or "Resource has been exhausted" in str(e)
+
+
+class QuotaScheduler:
+
+    # requests_per_minute / requests_per_day = None means unlimited (e.g. local inference)
+    def __init__(self, requests_per_minute=None, requests_per_day=None):
+        self.requests_per_minute = requests_per_minute
+        self.requests_per_day = requests_per_day
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0.0
+        self.next_slot = 0.0
+        self.condition = threading.Condition()
+
+        self.queue = []                 # heap of (priority, finish tag, sequence)
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.finish_tags = {}           # session -> finish tag of its last request
+        self.weights = {}               # session -> share weight (default 1)
+
+        self.day = None
+        self.used_today = 0
+        self.reserved = {}              # session -> admitted requests not sent yet
+        self.active_jobs = {}           # session -> admitted jobs still running
+
+    def set_weight(self, session, weight):
+        with self.condition:
+            self.weights[session or DEFAULT_SESSION] = weight
+
+    def _roll_day(self):
+        today = time.strftime("%Y-%m-%d")
+        if today != self.day:
+            self.day = today
+            self.used_today = 0
+
+    def remaining_today(self):
+        if not self.requests_per_day:
+            return None
+        with self.condition:
+            self._roll_day()
+            return max(0, self.requests_per_day - self.used_today - sum(self.reserved.values()))
+
+    # Reserve quota for a job of `requests` calls. False = it wouldn't fit today.
+    def admit(self, session, requests):
+        session = session or DEFAULT_SESSION
+        if not self.requests_per_day:
+            return True
+        with self.condition:
+            self._roll_day()
+            available = self.requests_per_day - self.used_today - sum(self.reserved.values())
+            if requests > available:
+                return False
+            self.reserved[session] = self.reserved.get(session, 0) + requests
+            self.active_jobs[session] = self.active_jobs.get(session, 0) + 1
+            return True
+
+    # Job finished: once the session's last job is done, hand back whatever
+    # it reserved but didn't use (cache hits, skipped pages)
+    def release(self, session):
+        session = session or DEFAULT_SESSION
+        if not self.requests_per_day:
+            return
+        with self.condition:
+            self.active_jobs[session] = self.active_jobs.get(session, 1) - 1
+            if self.active_jobs[session] <= 0:
+                self.active_jobs.pop(session, None)
+                self.reserved.pop(session, None)
+
+    # Blocks until the caller may send one request
+    def acquire(self, session=DEFAULT_SESSION, priority=PRIORITY_INTERACTIVE):
+        session = session or DEFAULT_SESSION
+        with self.condition:
+            self._roll_day()
+            self.used_today += 1
+            if self.reserved.get(session):
+                self.reserved[session] -= 1
+            if not self.interval:
+                return
+
+            start = max(self.virtual_time, self.finish_tags.get(session, 0.0))
+            finish = start + 1.0 / self.weights.get(session, 1.0)
+            self.finish_tags[session] = finish
+            ticket = (priority, finish, next(self.sequence))
+            heapq.heappush(self.queue, ticket)
+            self.condition.notify_all()
+
+            while True:
+                now = time.monotonic()
+                if self.queue[0] == ticket and now >= self.next_slot:
+                    heapq.heappop(self.queue)
+                    self.next_slot = now + self.interval
+                    self.virtual_time = max(self.virtual_time, start)
+                    self.condition.notify_all()
+                    return
+                # Only the head of the queue waits for the slot; everyone else waits their turn
+                self.condition.wait(self.next_slot - now if self.queue[0] == ticket else None)
+
+    # The provider pushed back (429/503): hold every caller, not just the one that got it
+    def backoff(self, seconds):
+        with self.condition:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "used_today": self.used_today,
+                "reserved": sum(self.reserved.values()),
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(backend):
+    key = (backend.name, getattr(backend, "model_name", None))
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = QuotaScheduler(backend.requests_per_minute, backend.requests_per_day)
+        return _schedulers[key]
+
+
+def all_schedulers():
+    with _schedulers_lock:
+        return dict(_schedulers)
+
+##################################################################
+# 2. Adaptive concurrency (AIMD)
+#
+# The per-minute cap above is only a ceiling. How many requests can be in
+# flight at once is learned: every round (one request per slot) the limit
+# grows by one while p95 latency stays near its recent baseline; it is cut by a
+# quarter when p95 climbs and halved on a 429/503. The pipeline therefore
+# runs as fast as the quota actually allows, on free and paid tiers alike.
+
+MIN_CONCURRENCY = 1
+LATENCY_WINDOW = 50             # recent latencies used for p95
+LATENCY_TOLERANCE = 2.0         # p95 above this × the baseline p95 counts as congestion
+BASELINE_DRIFT = 0.2            # share of the gap the baseline moves up each round (falls at once)
+LATENCY_DECREASE = 0.75         # limit factor when latency climbs
+THROTTLE_DECREASE = 0.5         # limit factor on a 429/503
+MAX_BUFFERED = 32               # finished results held back to keep input order
+
+
+class ConcurrencyController:
+
+    def __init__(self, max_concurrency, min_concurrency=MIN_CONCURRENCY):
+        self.max_concurrency = max(min_concurrency, max_concurrency)
+        self.min_concurrency = min_concurrency
+        self.current = float(min_concurrency)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.baseline_p95 = None
+        self.round_count = 0            # requests finished since the last adjustment
+        self.throttled_this_round = False
+        self.completed = deque()        # finish times over the last minute (throughput)
+        self.throttled = 0
+
+    @property
+    def limit(self):
+        return int(self.current)
+
+    # Blocks until fewer than `limit` requests are in flight
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def _p95(self):
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))] if ordered else None
+
+    def record(self, latency=None, throttled=False):
+        with self.condition:
+            now = time.monotonic()
+            if throttled:
+                # Multiplicative decrease, once per round: the other requests already in
+                # flight hit the same limit and report the same 429
+                self.throttled += 1
+                if not self.throttled_this_round:
+                    self.current = max(self.min_concurrency, self.current * THROTTLE_DECREASE)
+                    self.throttled_this_round = True
+                    self.round_count = 0
+                return
+
+            self.latencies.append(latency)
+            self.completed.append(now)
+            while self.completed and self.completed[0] < now - 60:
+                self.completed.popleft()
+
+            self.round_count += 1
+            if self.round_count < self.limit:
+                return
+            self.round_count = 0
+            self.throttled_this_round = False
+
+            p95 = self._p95()
+            congested = self.baseline_p95 is not None and p95 > self.baseline_p95 * LATENCY_TOLERANCE
+            # The baseline follows faster rounds at once and slower ones gradually: a run of quick
+            # "NONE" pages must not make every normal page look like congestion from then on
+            if self.baseline_p95 is None or p95 < self.baseline_p95:
+                self.baseline_p95 = p95
+            else:
+                self.baseline_p95 += BASELINE_DRIFT * (p95 - self.baseline_p95)
+            if congested:
+                self.current = max(self.min_concurrency, self.current * LATENCY_DECREASE)
+            else:
+                # Additive increase: one more slot per healthy round
+                self.current = min(self.max_concurrency, self.current + 1)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            p95 = self._p95()
+            return {
+                "concurrency": self.limit,
+                "in_flight": self.in_flight,
+                "throughput_per_min": sum(1 for t in self.completed if t >= now - 60),
+                "p95_latency_sec": round(p95, 2) if p95 is not None else None,
+                "throttled": self.throttled,
+            }
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(backend):
+    key = (backend.name, getattr(backend, "model_name", None))
+    with _controllers_lock:
+        if key not in _controllers:
+            _controllers[key] = ConcurrencyController(backend.max_concurrency)
+        return _controllers[key]
+
+
+def all_controllers():
+    with _controllers_lock:
+        return dict(_controllers)
+
+
+# input: backend, function making one request to it
+# output: fn()'s result. Each attempt holds a concurrency slot, then waits its turn at
+#         the quota; a 429/503 backs off everyone on this model and retries.
+def call_with_retry(backend, fn):
+    scheduler = get_scheduler(backend)
+    controller = get_controller(backend)
+    session, priority = current_scheduling()
+    for attempt in range(MAX_RETRIES + 1):
+        with controller.slot():
+            scheduler.acquire(session, priority)
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                if not _retry_after(e, attempt, controller):
+                    raise
+            else:
+                controller.record(time.monotonic() - started)
+                return result
+        # Back off outside the slot so other work can use it
+        scheduler.backoff(BACKOFF_SECONDS * 2 ** attempt)
+
+
+# input: backend, function starting one streamed request (returns an iterator of pieces)
+# output: generator of the pieces. Same slot, quota and retry path as call_with_retry;
+#         the slot is held until the stream ends, and only a failure before the
+#         first piece is retried (nothing has reached the reader yet).
+def stream_with_retry(backend, fn):
+    scheduler = get_scheduler(backend)
+    controller = get_controller(backend)
+    session, priority = current_scheduling()
+    for attempt in range(MAX_RETRIES + 1):
+        with controller.slot():
+            scheduler.acquire(session, priority)
+            started = time.monotonic()
+            try:
+                pieces = iter(fn())
+                first = next(pieces, None)
+            except Exception as e:
+                if not _retry_after(e, attempt, controller):
+                    raise
+            else:
+                if first is not None:
+                    yield first
+                yield from pieces
+                controller.record(time.monotonic() - started)
+                return
+        scheduler.backoff(BACKOFF_SECONDS * 2 ** attempt)
+
+
+# Records a failed request; True if it was rate limited and has retries left
+def _retry_after(e, attempt, controller):
+    if not is_rate_limit_error(e):
+        return False
+    controller.record(throttled=True)
+    return attempt < MAX_RETRIES
+
+
+# input: function, iterable of items (read lazily), controller for the backend being called
+# output: generator of fn(item) in input order, with up to controller.limit calls running at once
+def map_concurrent(fn, items, controller):
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=controller.max_concurrency, thread_name_prefix="llm") as pool:
+        for item in items:
+            while True:
+                running = [f for f in pending if not f.done()]
+                if len(running) < controller.limit and len(pending) < MAX_BUFFERED:
+                    break
+                wait(running or [pending[0]], return_when=FIRST_COMPLETED)
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+            # Each call runs in a copy of this context, so it keeps the job's scheduling session/priority
+            pending.append(pool.submit(contextvars.copy_context().run, fn, item))
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+##################################################################
+# 3. Shared response cache
+#
+# Identical prompts (same page + same examples, re-runs, several tenants
+# uploading the same plan) are answered from memory instead of the quota.
+
+class ResponseCache:
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(backend, prompt):
+        raw = f"{backend.name}\x00{getattr(backend, 'model_name', '')}\x00{prompt}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache()
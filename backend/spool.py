@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import tempfile
+import weakref
+
+import pymupdf
+
+##################################################################
+# 1. Spool settings
+#
+# Uploads are copied to a temp file once, in small pieces, and every reader
+# opens that file by path. MuPDF then reads pages from disk as they are
+# used, so a 200 MB binder costs a page or two of memory per job instead
+# of several full copies (getvalue(), BytesIO, the OCR workers' copies).
+
+SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None   # None = system temp dir
+COPY_BUFFER = 1024 * 1024                                 # bytes copied at a time
+
+##################################################################
+# 2. Spooled upload
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SpooledUpload:
+
+    # input: uploaded file object (Streamlit UploadedFile, FastAPI UploadFile.file, open file),
+    #        its original name, optional id of the upload it came from
+    def __init__(self, file_obj, name=None, source_id=None, directory=SPOOL_DIR):
+        self.name = name or getattr(file_obj, "name", "upload")
+        self.source_id = source_id
+        fd, self.path = tempfile.mkstemp(suffix=os.path.splitext(self.name)[1], prefix="upload-", dir=directory)
+        # The temp file goes away with this object even if close() is never called
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+
+        if isinstance(file_obj, (bytes, bytearray)):
+            file_obj = io.BytesIO(file_obj)
+        if hasattr(file_obj, "seek"):
+            file_obj.seek(0)
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(file_obj, out, COPY_BUFFER)
+        self.size = os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+##################################################################
+# 3. Open by path when we can
+
+# Path of a spooled upload or a plain path string, else None (in-memory file objects)
+def source_path(file_obj):
+    if isinstance(file_obj, (str, os.PathLike)):
+        return os.fspath(file_obj)
+    return getattr(file_obj, "path", None)
+
+
+def open_pdf(file_obj):
+    path = source_path(file_obj)
+    if path:
+        return pymupdf.open(path)
+    return pymupdf.open(stream=file_obj, filetype="pdf")
@@ -0,0 +1,114 @@
+from collections import Counter
+
+from backend.label_spans import (at_line_start, compile_label_regex, extract_label_spans, page_edge_lines,
+                                 running_lines)
+
+
+# Same page record build_label_index produces, without reading a document
+def make_page(locator, text, policy_labels, excluded_labels=None):
+    pattern = compile_label_regex(policy_labels)
+    boundaries = [(m.start(), m.end(), m.group(0).strip(), policy_labels[int(m.lastgroup[len("label"):])])
+                  for m in pattern.finditer(text) if at_line_start(text, m.start())]
+    excluded_pattern = compile_label_regex(excluded_labels)
+    if excluded_pattern is not None:
+        boundaries.extend((m.start(), m.end(), m.group(0).strip(), None)
+                          for m in excluded_pattern.finditer(text) if at_line_start(text, m.start()))
+    return {"locator": locator, "seq": locator, "text": text, "boundaries": sorted(boundaries)}
+
+
+def make_index(pages, heads=None):
+    return {"unit": "pages", "pages": pages, "heads": heads or {}}
+
+
+def test_cuts_policies_between_labels():
+    page = make_page(1, "Policy 1.1: Plant street trees.\nPolicy 1.2: Water them weekly.", ["Policy 1.1"])
+    extracted, ambiguous = extract_label_spans(make_index([page]))
+    assert extracted == {1: "- Policy 1.1: Plant street trees.\n- Policy 1.2: Water them weekly."}
+    assert ambiguous == []
+
+
+def test_last_policy_continues_onto_next_page_head():
+    page = make_page(3, "Policy 2.1: Keep sidewalks wide and", ["Policy 2.1"])
+    label_index = make_index([page], heads={4: "free of obstacles.\n"})
+    extracted, _ = extract_label_spans(label_index)
+    assert extracted[3] == "- Policy 2.1: Keep sidewalks wide and free of obstacles."
+
+
+def test_finished_sentence_does_not_take_next_page_head():
+    page = make_page(3, "Policy 2.1: Keep sidewalks wide.", ["Policy 2.1"])
+    label_index = make_index([page], heads={4: "Chapter 3 introduction text"})
+    extracted, _ = extract_label_spans(label_index)
+    assert extracted[3] == "- Policy 2.1: Keep sidewalks wide."
+
+
+def test_excluded_labels_end_a_policy():
+    text = "Policy 1.1: Plant street trees.\nProgram 1.1: Fund a planting crew.\nPolicy 1.2: Water them weekly."
+    page = make_page(1, text, ["Policy 1.1"], excluded_labels=["Program 1.1"])
+    extracted, _ = extract_label_spans(make_index([page]))
+    assert extracted[1] == "- Policy 1.1: Plant street trees.\n- Policy 1.2: Water them weekly."
+
+
+def test_unconfirmed_labels_end_a_policy_without_being_extracted():
+    text = "Goal 1: Greener streets.\nPolicy 1.1: Plant street trees.\nGoal 2: Safer streets."
+    page = make_page(1, text, ["Policy 1.1", "Goal 1"])
+    extracted, _ = extract_label_spans(make_index([page]), policy_labels=["Policy 1.1"])
+    assert extracted[1] == "- Policy 1.1: Plant street trees."
+
+
+def test_duplicate_labels_go_to_the_model():
+    # Table of contents: the same label listed twice
+    page = make_page(2, "Policy 1.1 Street Trees ........ 12\nPolicy 1.1 Street Trees ........ 14", ["Policy 1.1"])
+    extracted, ambiguous = extract_label_spans(make_index([page]))
+    assert extracted == {}
+    assert ambiguous == [page]
+
+
+def test_labels_only_in_running_text_go_to_the_model():
+    page = make_page(2, "Projects must be consistent with Policy 1.1 and Policy 1.2.", ["Policy 1.1"])
+    extracted, ambiguous = extract_label_spans(make_index([page]))
+    assert page["boundaries"] == []
+    assert extracted == {}
+    assert ambiguous == [page]
+
+
+def test_overlong_span_goes_to_the_model():
+    page = make_page(5, "Policy 3.1: " + "Narrative text. " * 10 + "\nPolicy 3.2: Short.", ["Policy 3.1"])
+    extracted, ambiguous = extract_label_spans(make_index([page]), max_chars=50)
+    assert extracted == {}
+    assert ambiguous == [page]
+
+
+def test_next_page_starting_with_running_header_is_skipped():
+    page = make_page(3, "Policy 2.1: Keep sidewalks wide and\nCity of Springfield General Plan\n3-14",
+                     ["Policy 2.1"])
+    label_index = make_index([page], heads={4: "City of Springfield General Plan\nfree of obstacles.\n"})
+    label_index["running_lines"] = {"city of springfield general plan", "#-#"}
+    extracted, _ = extract_label_spans(label_index)
+    assert extracted[3] == "- Policy 2.1: Keep sidewalks wide and free of obstacles."
+
+
+def test_next_page_starting_with_unknown_header_goes_to_the_model():
+    page = make_page(3, "Policy 2.1: Keep sidewalks wide and", ["Policy 2.1"])
+    label_index = make_index([page], heads={4: "City of Springfield General Plan\nfree of obstacles.\n"})
+    extracted, ambiguous = extract_label_spans(label_index)
+    assert extracted == {}
+    assert ambiguous == [page]
+
+
+def test_next_page_starting_with_heading_goes_to_the_model():
+    page = make_page(3, "Policy 2.1: Maintain defensible space around all structures", ["Policy 2.1"])
+    label_index = make_index([page], heads={4: "Section heading 1\nThis section describes hazards.\n"})
+    extracted, ambiguous = extract_label_spans(label_index)
+    assert extracted == {}
+    assert ambiguous == [page]
+
+
+def test_running_lines_repeat_at_page_edges():
+    pages = [f"Safety Element {n}\nPolicy S-{n}.1: Text.\nBody line {n} is unique.\nCity of Springfield"
+             for n in range(1, 5)]
+    counts = Counter()
+    for text in pages:
+        counts.update(page_edge_lines(text))
+    running = running_lines(counts)
+    assert "safety element #" in running
+    assert "city of springfield" in running
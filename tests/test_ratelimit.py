@@ -0,0 +1,32 @@
+from backend.ratelimit import ConcurrencyController
+
+
+def record_many(controller, latency, count):
+    for _ in range(count):
+        controller.record(latency)
+
+
+def test_limit_recovers_after_fast_pages_set_a_low_baseline():
+    controller = ConcurrencyController(max_concurrency=8)
+    controller.current = 8.0
+    # A run of quick "NONE" answers, then steady normal pages and no 429s
+    record_many(controller, 0.5, 40)
+    record_many(controller, 2.0, 400)
+    assert controller.limit == 8
+
+
+def test_latency_climbing_cuts_the_limit():
+    controller = ConcurrencyController(max_concurrency=8)
+    controller.current = 8.0
+    record_many(controller, 0.5, 50)
+    record_many(controller, 5.0, 16)
+    assert controller.limit < 8
+
+
+def test_concurrent_429s_halve_the_limit_once():
+    controller = ConcurrencyController(max_concurrency=8)
+    controller.current = 8.0
+    for _ in range(5):
+        controller.record(throttled=True)
+    assert controller.limit == 4
+    assert controller.stats()["throttled"] == 5